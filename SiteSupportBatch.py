@@ -0,0 +1,82 @@
+import argparse
+import sys
+
+# Only the Qt-free pipeline is imported here, so the batch build starts without loading PyQt5
+import SiteSupportCore
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Build the AutoData parts catalog broadcast (UP####.ZIP files) without the GUI."
+    )
+    parser.add_argument('--pronto-aces', help="PRONTO_ACES catalog folder (default: PRONTO_ACES in the current directory)")
+    parser.add_argument('--partsbox', help="PARTSBOX folder with the PART####.DAT files (default: PARTSBOX in the current directory)")
+    parser.add_argument('--take5', help="CSV of Take 5 site numbers to route into TAKE5UPDATE")
+    parser.add_argument('--output', help="Folder to build PROCESSED and TAKE5UPDATE in (default: UPDATE in the current directory)")
+    parser.add_argument('--workers', type=int, default=SiteSupportCore.BUILD_WORKERS,
+                        help="Number of worker processes for the site build (default: one per CPU core)")
+    parser.add_argument('--ingest', choices=SiteSupportCore.INGEST_MODES, default='in-place',
+                        help="Build from the given folders in place (default), or sync/hardlink them into "
+                             "PRONTO_ACES and PARTSBOX in the current directory first")
+    parser.add_argument('--profile', action='store_true', default=SiteSupportCore.PROFILE_RUN,
+                        help="Profile the run with cProfile and save MASTER.prof next to MASTER.log")
+    parser.add_argument('--log-format', choices=SiteSupportCore.LOG_FORMATS, default='text',
+                        help="Write MASTER.log as plain text lines (default) or as JSON lines with per-site fields")
+    parser.add_argument('--resume', action='store_true',
+                        help="Skip the sites an interrupted or cancelled run already built")
+    parser.add_argument('--sites',
+                        help="Rebuild only these sites: a list or ranges such as \"0105,0200-0210\", or a CSV "
+                             "in the Take 5 format; MASTER.CSV, UNUSED.CSV and COVERAGE.CSV are left unchanged")
+    parser.add_argument('--no-verify', dest='verify', action='store_false', default=SiteSupportCore.VERIFY_BUILD,
+                        help="Skip checking the CRCs and member lists of the site ZIPs after the build")
+    args = parser.parse_args(argv)
+    site_filter = None
+    if args.sites:
+        try:
+            site_filter = SiteSupportCore.parse_site_filter(args.sites)
+        except ValueError as e:
+            parser.error(str(e))
+        if not site_filter:
+            parser.error("--sites does not name any site")
+
+    partfiles_dir = args.partsbox
+    masterfiles_dir = args.pronto_aces
+    if args.ingest != 'in-place':
+        if masterfiles_dir:
+            masterfiles_dir = SiteSupportCore.ingest_folder(masterfiles_dir, 'PRONTO_ACES', args.ingest, normalize_prefix=True)
+        if partfiles_dir:
+            partfiles_dir = SiteSupportCore.ingest_folder(partfiles_dir, 'PARTSBOX', args.ingest)
+    SiteSupportCore.configure_directories(partfiles_dir, masterfiles_dir, args.output)
+    SiteSupportCore.set_log_format(args.log_format)
+
+    progress = [0]
+
+    def show_progress(value):
+        progress[0] = value
+
+    def show_status(message):
+        print(f"[{progress[0]:3d}%] {message}", flush=True)
+
+    try:
+        result = SiteSupportCore.run_update_build(args.take5, args.workers, show_progress, show_status, args.profile,
+                                                  resume=args.resume, site_filter=site_filter, verify=args.verify)
+    except KeyboardInterrupt:
+        print("Build interrupted, run again with --resume to finish the remaining sites.", file=sys.stderr)
+        return 130
+    except Exception as e:
+        SiteSupportCore.logger.exception(f"An error occurred: {str(e)}")
+        print(f"An error occurred: {str(e)}", file=sys.stderr)
+        return 1
+    if result is None:
+        print("No .DAT files found or PARTSBOX directory is empty or doesn't exist.", file=sys.stderr)
+        return 1
+
+    rebuilt_sites, reused_sites, failed_sites = result
+    if failed_sites:
+        print(f"Failed sites: {', '.join(failed_sites)}", file=sys.stderr)
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
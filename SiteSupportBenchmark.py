@@ -0,0 +1,322 @@
+import argparse
+import builtins
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+# Only the Qt-free pipeline is needed, the benchmark runs every stage headlessly
+import SiteSupportCore
+
+STAGES = (
+    'check_PRONTO_ACES', 'parse_dat_files', 'create_update_folders', 'zip_update_folder',
+    'build_sites', 'mark_unused_csv', 'move_to_take5_update',
+)
+
+BRAND_NAMES = ['WIX', 'FRAM', 'ACD', 'MOT', 'PUR', 'STP', 'BOS', 'CHA', 'VAL', 'MOB', 'NAP', 'CAR']
+
+
+def generate_synthetic_tree(root, sites=200, parts=2000, brands_per_part=3, rows_per_site=400,
+                            file_size=32 * 1024, missing_ratio=0.05, take5_ratio=0.1, seed=1):
+    # Write PARTSBOX/PART####.DAT, PRONTO_ACES/A_<part>/A_<part>_<brand>.DBF/.NDX and TAKE5.CSV under root.
+    # File contents are fixed-width text records, so they deflate about as well as the real catalog.
+    rng = random.Random(seed)
+    partfiles_dir = os.path.join(root, 'PARTSBOX')
+    masterfiles_dir = os.path.join(root, 'PRONTO_ACES')
+    os.makedirs(partfiles_dir, exist_ok=True)
+    os.makedirs(masterfiles_dir, exist_ok=True)
+
+    part_codes = [str(100000 + number) for number in range(parts)]
+    part_brands = {part_code: rng.sample(BRAND_NAMES, min(brands_per_part, len(BRAND_NAMES))) for part_code in part_codes}
+    for part_code in part_codes:
+        # A few parts have no catalog folder, so the unused report has work to do
+        if rng.random() < missing_ratio:
+            continue
+        folder = os.path.join(masterfiles_dir, f'A_{part_code}')
+        os.makedirs(folder, exist_ok=True)
+        for brand_code in part_brands[part_code]:
+            for extension, size in (('.DBF', file_size), ('.NDX', max(file_size // 4, 64))):
+                record = f"{part_code}{brand_code}{rng.randrange(10 ** 8):08d}".ljust(64) + "\r\n"
+                with open(os.path.join(folder, f'A_{part_code}_{brand_code}{extension}'), 'w', newline='') as catalog_file:
+                    catalog_file.write((record * (size // len(record) + 1))[:size])
+
+    for site in range(1, sites + 1):
+        with open(os.path.join(partfiles_dir, f'PART{site:04d}.DAT'), 'w') as dat_file:
+            dat_file.write('"LINE","LOC","PART","DESCRIPTION","BRAND","BRANDNAME"\n')
+            for line_number, part_code in enumerate(rng.sample(part_codes, min(rows_per_site, parts)), start=1):
+                brand_code = rng.choice(part_brands[part_code])
+                dat_file.write(f'"{line_number}","{site}","A_{part_code}","Part {part_code} {brand_code}",'
+                               f'"{brand_code}","{brand_code} Products"\n')
+
+    take5_sites = sorted(rng.sample(range(1, sites + 1), int(sites * take5_ratio)))
+    with open(os.path.join(root, 'TAKE5.CSV'), 'w') as take5_csv:
+        take5_csv.writelines(f'{site:04d}\n' for site in take5_sites)
+
+
+def throttle_reads(root, latency):
+    # Stand-in for a mapped network share: every open() of a file under root for reading waits latency seconds first.
+    # Pool workers inherit this where processes are forked (Linux) but not where they are spawned (Windows, macOS).
+    root = os.path.abspath(root)
+    real_open = builtins.open
+
+    def slow_open(file, mode='r', *args, **kwargs):
+        if ('r' in mode and isinstance(file, (str, bytes, os.PathLike))
+                and os.path.abspath(os.fsdecode(file)).startswith(root)):
+            time.sleep(latency)
+        return real_open(file, mode, *args, **kwargs)
+
+    builtins.open = slow_open
+    return lambda: setattr(builtins, 'open', real_open)
+
+
+def _process_rss(pid='self'):
+    # Resident set size of one process in bytes, or None where /proc is not available or the process is gone
+    try:
+        with open(f'/proc/{pid}/statm', 'r') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _child_pids():
+    # Direct children of this process, such as the pool workers of the build and parse stages
+    pids = set()
+    try:
+        for task in os.listdir('/proc/self/task'):
+            with open(f'/proc/self/task/{task}/children', 'r') as children:
+                pids.update(children.read().split())
+        return pids
+    except OSError:
+        pass
+    # Kernels without the children file: look for processes whose parent is this one
+    parent = str(os.getpid())
+    for pid in filter(str.isdigit, os.listdir('/proc')):
+        try:
+            with open(f'/proc/{pid}/stat', 'r') as stat:
+                if stat.read().rsplit(')', 1)[1].split()[1] == parent:
+                    pids.add(pid)
+        except (OSError, IndexError):
+            continue
+    return pids
+
+
+def _current_rss():
+    # Resident set size in bytes of this process plus its worker processes, or None where /proc is not available.
+    # Pages forked workers still share with this process are counted once per process.
+    rss = _process_rss()
+    if rss is None:
+        return None
+    return rss + sum(filter(None, map(_process_rss, _child_pids())))
+
+
+def _peak_rss():
+    # High-water mark of this process alone in bytes, used when /proc sampling is not available
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _io_counters():
+    # (bytes read, bytes written) by this process through read/write calls, where the platform reports them
+    try:
+        with open('/proc/self/io', 'r') as io_file:
+            counters = dict(line.split(': ') for line in io_file.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+class StageMeter:
+    """Times one stage and samples its peak RSS, including pool worker processes, on a background thread."""
+
+    def __init__(self, name, interval=0.01):
+        self.name = name
+        self.interval = interval
+        self.peak_rss = None
+        # 'process tree' when sampled from /proc, 'parent only' when falling back to getrusage
+        self.rss_scope = 'process tree'
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.is_set():
+            rss = _current_rss()
+            if rss is not None and (self.peak_rss is None or rss > self.peak_rss):
+                self.peak_rss = rss
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._read_before, self._written_before = _io_counters()
+        self._sampler.start()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self._start
+        self._stop.set()
+        self._sampler.join()
+        if self.peak_rss is None:
+            self.peak_rss = _peak_rss()
+            self.rss_scope = 'parent only'
+        read_after, written_after = _io_counters()
+        self.read_bytes = read_after - self._read_before if read_after is not None else None
+        self.written_bytes = written_after - self._written_before if written_after is not None else None
+
+
+def _tree_size(*folders, suffix=None):
+    files = 0
+    total_bytes = 0
+    for folder in folders:
+        for root_path, _, filenames in os.walk(folder):
+            for filename in filenames:
+                if suffix is None or filename.upper().endswith(suffix):
+                    files += 1
+                    total_bytes += os.path.getsize(os.path.join(root_path, filename))
+    return files, total_bytes
+
+
+def run_benchmark(root, stages=STAGES, workers=None):
+    # Run the selected stages against the synthetic tree in root and return one result dict per stage
+    previous_cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        SiteSupportCore.configure_directories('PARTSBOX', 'PRONTO_ACES', 'UPDATE')
+        catalog_index = SiteSupportCore.load_catalog_index()
+        site_groups = None
+        data = None
+        results = []
+
+        def measure(name, run_stage, count_output):
+            if name not in stages:
+                return
+            with StageMeter(name) as meter:
+                run_stage()
+            files, total_bytes = count_output()
+            results.append({
+                'stage': name, 'seconds': round(meter.seconds, 4), 'peak_rss_bytes': meter.peak_rss, 'peak_rss_scope': meter.rss_scope,
+                'files': files, 'bytes': total_bytes,
+                'read_bytes': meter.read_bytes, 'written_bytes': meter.written_bytes,
+            })
+
+        def parse_stage():
+            # Same generators the build uses, parsing on the same worker count, kept per site for the build stages
+            nonlocal site_groups, data
+            site_groups = list(SiteSupportCore.iter_site_entries(SiteSupportCore.list_dat_files(), workers=workers))
+            data = SiteSupportCore.PartRecords()
+            for _, site_entries in site_groups:
+                data.extend(site_entries)
+
+        def staged_copy_stage():
+            for unique_id, site_entries in site_groups:
+                SiteSupportCore.create_update_folders(unique_id, site_entries, catalog_index)
+
+        def staged_zip_stage():
+            for unique_id, _ in site_groups:
+                SiteSupportCore.zip_update_folder(unique_id)
+
+        def direct_build_stage():
+            # The direct, pooled build writes to its own folder so it does not overwrite the staged ZIPs
+            SiteSupportCore.configure_directories('PARTSBOX', 'PRONTO_ACES', 'UPDATE_DIRECT')
+            dat_index = SiteSupportCore.index_part_dat_files()
+            site_plans = [(unique_id, SiteSupportCore.plan_site_files(unique_id, site_entries, catalog_index, dat_index))
+                          for unique_id, site_entries in site_groups]
+            SiteSupportCore.build_sites(site_plans, workers)
+            SiteSupportCore.configure_directories('PARTSBOX', 'PRONTO_ACES', 'UPDATE')
+
+        def take5_stage():
+            with open('TAKE5.CSV', 'r') as take5_csv:
+                take5_sites = [line.strip() for line in take5_csv if line.strip()]
+            SiteSupportCore.move_to_take5_update(take5_sites)
+
+        measure('check_PRONTO_ACES', SiteSupportCore.check_PRONTO_ACES,
+                lambda: _tree_size('PRONTO_ACES', suffix='.DBF'))
+        # Parsing is needed by every later stage, so it always runs even when it is not reported
+        if 'parse_dat_files' in stages:
+            measure('parse_dat_files', parse_stage, lambda: _tree_size('PARTSBOX', suffix='.DAT'))
+        else:
+            parse_stage()
+        measure('create_update_folders', staged_copy_stage,
+                lambda: _tree_size(*[SiteSupportCore.update_dir(unique_id) for unique_id, _ in site_groups]))
+        measure('zip_update_folder', staged_zip_stage, lambda: _tree_size(SiteSupportCore.update_dir('PROCESSED')))
+        measure('build_sites', direct_build_stage, lambda: _tree_size('UPDATE_DIRECT'))
+        measure('mark_unused_csv', lambda: SiteSupportCore.mark_unused_csv(data, catalog_index),
+                lambda: _tree_size('.', suffix='UNUSED.CSV') if os.path.exists('UNUSED.CSV') else (0, 0))
+        measure('move_to_take5_update', take5_stage, lambda: _tree_size(SiteSupportCore.update_dir('TAKE5UPDATE')))
+        return results
+    finally:
+        SiteSupportCore.configure_directories()
+        os.chdir(previous_cwd)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the broadcast pipeline on synthetic PARTSBOX/PRONTO_ACES data.")
+    parser.add_argument('--sites', type=int, default=200, help="Number of PART####.DAT files (default: 200)")
+    parser.add_argument('--parts', type=int, default=2000, help="Number of A_<part> catalog folders (default: 2000)")
+    parser.add_argument('--brands-per-part', type=int, default=3, help="Brands per part code (default: 3)")
+    parser.add_argument('--rows-per-site', type=int, default=400, help="Rows in each PART####.DAT (default: 400)")
+    parser.add_argument('--file-size', type=int, default=32 * 1024, help="Size of each .DBF in bytes (default: 32768)")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed for the synthetic data (default: 1)")
+    parser.add_argument('--workers', type=int, default=SiteSupportCore.BUILD_WORKERS,
+                        help="Worker processes for the build_sites stage (default: one per CPU core)")
+    parser.add_argument('--prefetch-threads', type=int, default=SiteSupportCore.PREFETCH_THREADS,
+                        help=f"Threads per process reading and deflating source files ahead (default: {SiteSupportCore.PREFETCH_THREADS})")
+    parser.add_argument('--read-latency', type=float, default=0,
+                        help="Milliseconds added to every file opened for reading in the synthetic tree, to stand in for a network share")
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES), help="Stages to run (default: all)")
+    parser.add_argument('--workdir', help="Folder to generate the data in (default: a temporary folder, removed afterwards)")
+    parser.add_argument('--output', help="Write the JSON results here instead of printing them")
+    parser.add_argument('--history', help="Also append the results as one JSON line to this file, for comparing runs")
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='sitesupport-bench-')
+    try:
+        scale = {
+            'sites': args.sites, 'parts': args.parts, 'brands_per_part': args.brands_per_part,
+            'rows_per_site': args.rows_per_site, 'file_size': args.file_size, 'seed': args.seed,
+        }
+        generate_synthetic_tree(workdir, **scale)
+        SiteSupportCore.PREFETCH_THREADS = args.prefetch_threads
+        restore_open = throttle_reads(workdir, args.read_latency / 1000) if args.read_latency else None
+        try:
+            stages = run_benchmark(workdir, args.stages, args.workers)
+        finally:
+            if restore_open:
+                restore_open()
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'workers': args.workers,
+        'prefetch_threads': args.prefetch_threads,
+        'read_latency_ms': args.read_latency,
+        'scale': scale,
+        'stages': stages,
+        'total_seconds': round(sum(stage['seconds'] for stage in stages), 4),
+    }
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.history:
+        with open(args.history, 'a') as history_file:
+            history_file.write(json.dumps(report) + '\n')
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1870 @@
+import os
+import csv
+import shutil
+import zipfile
+import logging
+import logging.handlers
+import atexit
+import queue
+import multiprocessing
+import json
+import zlib
+import struct
+import hashlib
+import re
+import errno
+import time
+import copy
+import tempfile
+import cProfile
+import pstats
+import threading
+import io
+import platform
+import locale
+from array import array
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import groupby
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+# Set up logging
+LOG_FILENAME = "MASTER.log"
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+# 'text' writes the usual lines, 'jsonl' one JSON object per line with per-site fields for analysis
+LOG_FORMATS = ('text', 'jsonl')
+logger = logging.getLogger("MASTER")
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """One JSON object per record: time, level and message, plus the site, files, bytes and ms of per-site records."""
+    RECORD_FIELDS = ('site', 'files', 'bytes', 'zip_bytes', 'ms')
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'message': record.getMessage()}
+        for field in self.RECORD_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that keeps a record's traceback in exc_text instead of folding it into the message.
+
+    The file handler's formatter then decides how to write it: after the message in text lines,
+    or as the exception key in JSON lines.
+    """
+    exception_formatter = logging.Formatter()
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.exception_formatter.formatException(record.exc_info)
+        # The traceback object cannot cross to a worker's parent process
+        record.exc_info = None
+        return record
+
+
+# Create formatter
+formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+
+# Create rotating file handler. Records are queued by the logging call and written by a background
+# thread, so the build never waits on MASTER.log; the queue is drained when the program exits.
+handler = logging.handlers.RotatingFileHandler(LOG_FILENAME, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, delay=True)
+handler.setFormatter(formatter)
+log_queue = queue.Queue()
+log_listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+logger.addHandler(LogQueueHandler(log_queue))
+logger.setLevel(logging.INFO)
+
+
+def set_log_format(log_format):
+    # Switch MASTER.log between plain text lines and JSON lines
+    handler.setFormatter(JsonLinesFormatter() if log_format == 'jsonl' else formatter)
+
+
+def _init_worker_logging(worker_log_queue):
+    # Pool workers send their records back to the parent process, the only one writing MASTER.log
+    for worker_handler in list(logger.handlers):
+        logger.removeHandler(worker_handler)
+    logger.addHandler(LogQueueHandler(worker_log_queue))
+
+
+@contextmanager
+def worker_pool(max_workers):
+    # Process pool whose workers log to MASTER.log through this process
+    worker_log_queue = multiprocessing.Queue()
+    worker_log_listener = logging.handlers.QueueListener(worker_log_queue, handler, respect_handler_level=True)
+    worker_log_listener.start()
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker_logging,
+                                 initargs=(worker_log_queue,)) as executor:
+            yield executor
+    finally:
+        worker_log_listener.stop()
+
+# Input and output folders; None means the folder of that name in the current directory
+PARTSBOX_DIR = None
+PRONTO_ACES_DIR = None
+UPDATE_DIR = None
+
+# MASTER.CSV is written as a side output while the DAT files stream through the build
+WRITE_MASTER_CSV = True
+
+# Entries whose catalog folder is missing or empty, written while the DAT files stream through the build
+UNUSED_CSV_FILENAME = "UNUSED.CSV"
+
+# How a selected PRONTO_ACES/PARTSBOX folder is brought in: 'sync' copies only new or changed files into the
+# local folder, 'hardlink' links them instead when both are on the same filesystem, 'in-place' builds straight
+# from the selected folder
+INGEST_MODES = ('sync', 'hardlink', 'in-place')
+INGEST_MODE = 'sync'
+
+# Per-stage and per-site timings of the last run, written next to MASTER.log
+RUN_REPORT_FILENAME = "RUN_REPORT.json"
+
+# Wrap the whole run in cProfile and save MASTER.prof next to MASTER.log
+PROFILE_RUN = False
+
+# Cached PRONTO_ACES file index, reused while the catalog folders are unchanged
+CATALOG_INDEX_FILENAME = "CATALOG_INDEX.json"
+
+# Write each UP####.ZIP straight from PRONTO_ACES and PARTSBOX instead of staging UPDATE/<id> first
+DIRECT_ZIP_MODE = True
+
+# Number of worker processes used to build site ZIPs; None uses one per CPU core
+BUILD_WORKERS = None
+
+# Catalog files are deflated once per build and the compressed bytes are reused by every site ZIP.
+# Each worker keeps up to COMPRESSED_CACHE_MEMORY bytes in memory, everything else is read back from
+# the shared on-disk cache under UPDATE/, which is removed when the build finishes.
+COMPRESSED_CACHE_DIRNAME = '.MEMBER_CACHE'
+COMPRESSED_CACHE_MEMORY = 64 * 1024 * 1024
+
+# Source files are stat'ed, read and deflated on PREFETCH_THREADS threads per process, up to PREFETCH_WINDOW
+# files ahead of the ZIP writer and while less than PREFETCH_MEMORY bytes of loaded members wait to be written,
+# so reads from a network share overlap with compression and writing
+PREFETCH_THREADS = 8
+PREFETCH_WINDOW = 32
+PREFETCH_MEMORY = 32 * 1024 * 1024
+
+# Sites with the same catalog file list share one prebuilt run of catalog members, copied into each
+# of their ZIPs after the site's own PART####.DAT. A group of identical sites is split into chunks of at
+# most this many sites (fewer when needed to keep every worker busy), each chunk building the shared part once.
+SHARED_MEMBERS_CHUNK = 64
+
+# Final folders under UPDATE/ that built ZIPs are written to: Take 5 sites go to TAKE5UPDATE, the rest to PROCESSED
+OUTPUT_DIRNAMES = ('PROCESSED', 'TAKE5UPDATE')
+
+# Hardlinks (copies where links are not supported) to every built ZIP, in UPDATE/ where Move Update does not
+# look, so unchanged sites can still be reused after their ZIPs were moved out of PROCESSED
+BUILT_ZIPS_DIRNAME = '.BUILT_ZIPS'
+
+# Chunk size used when a move has to copy between filesystems
+MOVE_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Check every site ZIP after the build: central directory, member CRCs and the member list against the plan
+VERIFY_BUILD = True
+VERIFY_CHUNK_SIZE = 1024 * 1024
+
+# Encoding of the PART####.DAT files; the system's default, which they were always read with
+DAT_ENCODING = locale.getpreferredencoding(False)
+
+# DAT files each parse worker may have queued ahead of the site being planned
+DAT_PARSE_AHEAD = 4
+
+# Per-site record of the inputs behind each UP####.ZIP, used to rebuild only the sites that changed
+BUILD_MANIFEST_FILENAME = "BUILD_MANIFEST.json"
+BUILD_MANIFEST_VERSION = 1
+
+# Sites finished so far in the current run, kept under UPDATE/ so an interrupted run can be resumed.
+# Rewritten at most once every RUN_JOURNAL_SAVE_INTERVAL seconds while sites are finishing.
+RUN_JOURNAL_FILENAME = "RUN_JOURNAL.json"
+RUN_JOURNAL_SAVE_INTERVAL = 1.0
+
+
+def configure_directories(partsbox=None, pronto_aces=None, update=None):
+    # Point the pipeline at other input/output folders instead of the ones in the current directory
+    global PARTSBOX_DIR, PRONTO_ACES_DIR, UPDATE_DIR
+    PARTSBOX_DIR = os.path.abspath(partsbox) if partsbox else None
+    PRONTO_ACES_DIR = os.path.abspath(pronto_aces) if pronto_aces else None
+    UPDATE_DIR = os.path.abspath(update) if update else None
+
+
+def partsbox_dir():
+    return PARTSBOX_DIR or os.path.join(os.getcwd(), 'PARTSBOX')
+
+
+def pronto_aces_dir():
+    return PRONTO_ACES_DIR or os.path.join(os.getcwd(), 'PRONTO_ACES')
+
+
+def update_dir(*parts):
+    return os.path.join(UPDATE_DIR or os.path.join(os.getcwd(), 'UPDATE'), *parts)
+
+
+class RunReport:
+    """Timings and byte counts for one run, one record per stage and per site, saved as RUN_REPORT.json."""
+
+    def __init__(self):
+        self.started = datetime.now()
+        self.stages = []
+        self.sites = []
+
+    @contextmanager
+    def stage(self, name):
+        # Time a pipeline stage; the caller can add counts to the yielded record
+        record = {'stage': name}
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = round(time.perf_counter() - start, 4)
+            self.stages.append(record)
+            logger.info(f"Stage {name} finished in {record['seconds']:.2f} s.")
+
+    def add_site(self, site_stats):
+        self.sites.append(site_stats)
+
+    def totals(self):
+        built_sites = [site for site in self.sites if 'bytes_written' in site]
+        bytes_read = sum(site['bytes_read'] for site in built_sites)
+        bytes_written = sum(site['bytes_written'] for site in built_sites)
+        # Staged builds have no separate build stage, so fall back to the time spent on the sites themselves
+        build_seconds = sum(record['seconds'] for record in self.stages if record['stage'] == 'build')
+        build_seconds = build_seconds or sum(site['seconds'] for site in built_sites)
+        return {
+            'sites_built': len(built_sites),
+            'sites_reused': sum(1 for site in self.sites if site.get('reused')),
+            'sites_failed': sum(1 for site in self.sites if 'error' in site),
+            'files': sum(site['files'] for site in built_sites),
+            'bytes_read': bytes_read,
+            'bytes_written': bytes_written,
+            'compression_ratio': round(bytes_written / bytes_read, 4) if bytes_read else None,
+            'build_mb_per_second': round(bytes_read / build_seconds / 1e6, 2) if build_seconds else None,
+            'total_seconds': round(sum(record['seconds'] for record in self.stages), 4),
+        }
+
+    def log_summary(self):
+        totals = self.totals()
+        logger.info("Run summary:")
+        for record in self.stages:
+            logger.info(f"  {record['stage']}: {record['seconds']:.2f} s")
+        logger.info(f"  {totals['sites_built']} sites built, {totals['sites_reused']} reused, {totals['sites_failed']} failed, "
+                    f"{totals['files']} files, {totals['bytes_read'] / 1e6:.1f} MB read, "
+                    f"{totals['bytes_written'] / 1e6:.1f} MB written, compression ratio {totals['compression_ratio']}")
+        slowest_sites = sorted((site for site in self.sites if 'seconds' in site), key=lambda site: site['seconds'], reverse=True)
+        for site in slowest_sites[:5]:
+            logger.info(f"  Slow site {site['site']}: {site['seconds']:.2f} s, {site['files']} files, {site['bytes_read'] / 1e6:.1f} MB")
+
+    def save(self, filename=RUN_REPORT_FILENAME):
+        with open(filename, 'w') as report_file:
+            json.dump({
+                'started': self.started.isoformat(timespec='seconds'),
+                'stages': self.stages,
+                'totals': self.totals(),
+                'sites': self.sites,
+            }, report_file, indent=2)
+
+
+class BuildProgress:
+    """Progress of a build weighted by the bytes planned for each site, with throughput and time left."""
+
+    def __init__(self, site_bytes, progress_callback=None, status_callback=None):
+        self.site_bytes = site_bytes
+        self.total_bytes = sum(site_bytes.values())
+        self.done_bytes = 0
+        self.progress_callback = progress_callback
+        self.status_callback = status_callback
+        self.start = time.perf_counter()
+
+    def rate(self):
+        # Bytes per second over the build so far
+        elapsed = time.perf_counter() - self.start
+        return self.done_bytes / elapsed if elapsed > 0 else 0.0
+
+    def seconds_left(self):
+        rate = self.rate()
+        return (self.total_bytes - self.done_bytes) / rate if rate else None
+
+    def site_done(self, unique_id, message):
+        self.done_bytes += self.site_bytes.get(unique_id, 0)
+        if self.progress_callback:
+            self.progress_callback(int(self.done_bytes * 100 / self.total_bytes) if self.total_bytes else 100)
+        if self.status_callback:
+            seconds_left = self.seconds_left()
+            eta = f"{int(seconds_left // 60)}:{int(seconds_left % 60):02d} left" if seconds_left is not None else "estimating"
+            self.status_callback(f"{message} ({self.rate() / 1e6:.1f} MB/s, {eta})")
+
+
+class BuildCancelled(Exception):
+    """Raised between sites when the run's cancel event is set."""
+
+
+class RunJournal:
+    """Sites finished in the current run, saved to UPDATE/RUN_JOURNAL.json so an interrupted run can be resumed."""
+
+    def __init__(self, resumed_sites=None):
+        self.path = update_dir(RUN_JOURNAL_FILENAME)
+        # Sites finished by the interrupted run, by Unique_ID, with the digest of the inputs they were built from
+        self.resumed_sites = resumed_sites or {}
+        self.sites = dict(self.resumed_sites)
+        self._last_save = 0.0
+
+    @classmethod
+    def load(cls):
+        # The journal left by an interrupted run, or an empty one when there is nothing to resume
+        journal_path = update_dir(RUN_JOURNAL_FILENAME)
+        if not os.path.exists(journal_path):
+            logger.info("No interrupted run to resume.")
+            return cls()
+        try:
+            with open(journal_path, 'r') as journal_file:
+                journal = json.load(journal_file)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable {journal_path}: {str(e)}")
+            return cls()
+        logger.info(f"Resuming {journal.get('state', 'running')} run with {len(journal.get('sites', {}))} sites already built.")
+        return cls(journal.get('sites', {}))
+
+    def is_done(self, unique_id, digest=''):
+        return self.resumed_sites.get(unique_id) == digest
+
+    def site_done(self, unique_id, digest=''):
+        self.sites[unique_id] = digest
+        if time.monotonic() - self._last_save >= RUN_JOURNAL_SAVE_INTERVAL:
+            self.save('running')
+
+    def save(self, state):
+        # Write to a temp file and rename, so a crash mid-write never leaves a truncated journal
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + '.tmp', 'w') as journal_file:
+            json.dump({'state': state, 'sites': self.sites}, journal_file)
+        os.replace(self.path + '.tmp', self.path)
+        self._last_save = time.monotonic()
+
+    def finish(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def has_resumable_run():
+    return os.path.exists(update_dir(RUN_JOURNAL_FILENAME))
+
+
+def clean_partial_artifacts(unique_ids):
+    # Remove what an interrupted run leaves behind: half-built UPDATE/<id> folders, UP<id>.ZIP files
+    # zipped into the current directory but never moved, unfinished .ZIP.tmp files, the member cache
+    # and the UNUSED.CSV of a run that never reached its reports
+    removed = 0
+    for unique_id in unique_ids:
+        if os.path.isdir(update_dir(unique_id)):
+            shutil.rmtree(update_dir(unique_id))
+            removed += 1
+        if os.path.exists(f"UP{unique_id}.ZIP"):
+            os.remove(f"UP{unique_id}.ZIP")
+            removed += 1
+    for output_dirname in OUTPUT_DIRNAMES:
+        output_directory = update_dir(output_dirname)
+        if not os.path.isdir(output_directory):
+            continue
+        for filename in os.listdir(output_directory):
+            if filename.upper().endswith('.ZIP.TMP'):
+                os.remove(os.path.join(output_directory, filename))
+                removed += 1
+    if os.path.isdir(update_dir(COMPRESSED_CACHE_DIRNAME)):
+        shutil.rmtree(update_dir(COMPRESSED_CACHE_DIRNAME))
+        removed += 1
+    if os.path.exists(UNUSED_CSV_FILENAME + '.tmp'):
+        os.remove(UNUSED_CSV_FILENAME + '.tmp')
+        removed += 1
+    if removed:
+        logger.info(f"Removed {removed} partial artifacts left by an earlier run.")
+
+
+def run_update_build(take5_file_path=None, workers=None, progress_callback=None, status_callback=None, profile=PROFILE_RUN,
+                     cancel_event=None, resume=False, site_filter=None, verify=VERIFY_BUILD):
+    # Run the whole broadcast: check the catalog, parse the DAT files, build every site, mark unused
+    # entries and route Take 5 sites. Returns the rebuilt, reused and failed Unique_IDs, or None when
+    # there were no DAT files to build from. Stage and site timings go to RUN_REPORT.json.
+    # Setting cancel_event (a threading.Event) stops the run between sites with BuildCancelled; the sites
+    # finished so far stay in RUN_JOURNAL.json, and resume=True skips them on the next run.
+    # With site_filter (a set of Unique_IDs, see parse_site_filter) only those sites are parsed and rebuilt.
+    # With verify, every built or reused ZIP is checked afterwards and the ones that fail count as failed sites.
+    run_report = RunReport()
+    # A partial build adds to the journal of an interrupted full run instead of replacing it
+    keep_journal = bool(site_filter) and has_resumable_run()
+    journal = RunJournal.load() if resume or keep_journal else RunJournal()
+    profiler = cProfile.Profile() if profile else None
+    run_args = (take5_file_path, workers, progress_callback, status_callback, run_report, cancel_event, journal, site_filter,
+                verify)
+    try:
+        result = profiler.runcall(_run_update_build, *run_args) if profiler else _run_update_build(*run_args)
+        if keep_journal:
+            # site_done saves at most once a second, so the last sites built would be missing otherwise
+            journal.save('running')
+        else:
+            journal.finish()
+        return result
+    except BuildCancelled:
+        logger.info(f"Build cancelled with {len(journal.sites)} sites built, resume to finish the rest.")
+        journal.save('cancelled')
+        raise
+    except BaseException:
+        journal.save('interrupted')
+        raise
+    finally:
+        run_report.log_summary()
+        run_report.save(os.path.join(os.path.dirname(handler.baseFilename), RUN_REPORT_FILENAME))
+        if profiler:
+            save_profile(profiler)
+
+
+def save_profile(profiler):
+    # cProfile only sees this process, so time spent inside pool workers shows up as waiting on futures
+    profile_path = os.path.splitext(handler.baseFilename)[0] + '.prof'
+    profiler.dump_stats(profile_path)
+    with open(profile_path + '.txt', 'w') as stats_file:
+        pstats.Stats(profiler, stream=stats_file).sort_stats('cumulative').print_stats(50)
+    logger.info(f"Profile saved to {profile_path}.")
+
+
+def _run_update_build(take5_file_path, workers, progress_callback, status_callback, run_report, cancel_event, journal,
+                      site_filter=None, verify=VERIFY_BUILD):
+    with run_report.stage('check_PRONTO_ACES'):
+        check_PRONTO_ACES()
+    dat_files = list_dat_files(site_filter)
+    if site_filter:
+        found_sites = set(unique_id for unique_id, _ in dat_files)
+        for site_number in sorted(set(site_filter).difference(found_sites)):
+            logger.warning(f"Selected site {site_number} has no PART{site_number}.DAT in PARTSBOX.")
+    if not dat_files:
+        logger.error("No .DAT files found or PARTSBOX directory is empty or doesn't exist.")
+        return None
+    with run_report.stage('load_catalog_index') as record:
+        if site_filter:
+            # Only the A_ folders the selected sites reference are looked at
+            part_codes = set(row[0] for _, dat_file in dat_files for row in iter_dat_rows(dat_file))
+            catalog_index = load_catalog_index(part_codes=part_codes)
+        else:
+            catalog_index = load_catalog_index()
+        record['folders'] = len(catalog_index['folders'])
+
+    # Stream the DAT rows site by site: each site's rows go to MASTER.CSV, UNUSED.CSV, its build plan and
+    # its coverage row in one pass, then are dropped, so memory does not grow with the number of DAT rows.
+    # Only each site's planned file list is kept, for the build and verify stages.
+    dat_index = index_part_dat_files()
+    unique_ids = sorted(set(unique_id for unique_id, _ in dat_files))
+    total_unique_ids = len(unique_ids)
+    clean_partial_artifacts(unique_ids)
+    # Take 5 sites are written straight to TAKE5UPDATE instead of being moved there after the build
+    take5_sites = read_take5_sites(take5_file_path) if take5_file_path else set()
+    for site_number in sorted(take5_sites.difference(unique_ids).intersection(site_filter or take5_sites)):
+        logger.warning(f"Take 5 site {site_number} has no PART{site_number}.DAT in PARTSBOX, UP{site_number}.ZIP will not be built.")
+    site_plans = []
+    unused_count = 0
+    part_has_files = {}
+    coverage_rows = []
+    rebuilt_sites, reused_sites, failed_sites = [], [], []
+    with run_report.stage('parse_and_plan') as record:
+        record['files'] = len(dat_files)
+        record['rows'] = 0
+        malformed = {}
+        site_entries_by_site = iter_site_entries(dat_files, workers=workers, malformed=malformed)
+        # A partial build leaves the whole-broadcast MASTER.CSV, UNUSED.CSV and COVERAGE.CSV as they are
+        master_csv = open('MASTER.CSV', 'w', newline='') if WRITE_MASTER_CSV and not site_filter else None
+        # Unused entries are written next to UNUSED.CSV and replace it in the reports stage
+        unused_csv = open(UNUSED_CSV_FILENAME + '.tmp', 'w', newline='') if not site_filter else None
+        try:
+            if master_csv:
+                master_writer = csv.writer(master_csv)
+                master_writer.writerow(['Part_Code_BrandCode', 'Description', 'BrandName', 'Unique_ID'])
+            if unused_csv:
+                unused_writer = csv.writer(unused_csv)
+                unused_writer.writerow(['Part_Code_BrandCode', 'Description', 'BrandName', 'Unique_ID'])
+            for idx, (unique_id, site_entries) in enumerate(site_entries_by_site, start=1):
+                if cancel_event and cancel_event.is_set():
+                    raise BuildCancelled()
+                record['rows'] += len(site_entries)
+                if master_csv:
+                    master_writer.writerows(site_entries)
+                if unused_csv:
+                    unused_entries = find_unused_entries(site_entries, catalog_index, part_has_files)
+                    unused_writer.writerows(unused_entries)
+                    unused_count += len(unused_entries)
+                site_files = plan_site_files(unique_id, site_entries, catalog_index, dat_index)
+                coverage_rows.append(site_coverage(unique_id, site_entries, site_files, catalog_index))
+                if DIRECT_ZIP_MODE or verify:
+                    site_plans.append((unique_id, site_files))
+                if DIRECT_ZIP_MODE:
+                    continue
+                if not site_filter and journal.is_done(unique_id) and reuse_existing_zip(unique_id, site_output_dir(unique_id, take5_sites)):
+                    reused_sites.append(unique_id)
+                    run_report.add_site({'site': unique_id, 'reused': True})
+                else:
+                    site_start = time.perf_counter()
+                    files_copied, bytes_read = create_update_folders(unique_id, site_entries, catalog_index)
+                    discard_stale_zips(unique_id)
+                    bytes_written = zip_update_folder(unique_id, site_output_dir(unique_id, take5_sites))
+                    keep_built_zip(unique_id, os.path.join(site_output_dir(unique_id, take5_sites), f"UP{unique_id}.ZIP"))
+                    run_report.add_site({
+                        'site': unique_id, 'seconds': round(time.perf_counter() - site_start, 4), 'files': files_copied,
+                        'bytes_read': bytes_read, 'bytes_written': bytes_written,
+                        'compression_ratio': round(bytes_written / bytes_read, 4) if bytes_read else None,
+                    })
+                    rebuilt_sites.append(unique_id)
+                    journal.site_done(unique_id)
+                if progress_callback:
+                    progress_callback(int((idx / total_unique_ids) * 100))
+                if status_callback:
+                    status_callback(f"Processing Site Number: {unique_id}")
+        finally:
+            # Stops the parse pool when the loop ends early
+            site_entries_by_site.close()
+            if master_csv:
+                master_csv.close()
+            if unused_csv:
+                unused_csv.close()
+        record['malformed_lines'] = sum(malformed.values())
+        if malformed:
+            logger.warning(f"Skipped {record['malformed_lines']} malformed lines in {len(malformed)} DAT files: "
+                           f"{', '.join(sorted(malformed))}")
+    if not DIRECT_ZIP_MODE and progress_callback:
+        # Sites without part rows are counted in total_unique_ids but never processed
+        progress_callback(100)
+
+    if DIRECT_ZIP_MODE:
+        # Bytes shipped per site, from the coverage rows, weight the build progress
+        site_bytes = {row[0]: row[4] for row in coverage_rows}
+        with run_report.stage('build') as record:
+            rebuilt_sites, reused_sites, failed_sites = build_changed_sites(
+                site_plans, workers, progress_callback, status_callback, run_report, cancel_event, journal, take5_sites,
+                site_bytes, partial=bool(site_filter))
+            record['sites'] = len(rebuilt_sites) + len(failed_sites)
+    if verify:
+        built_sites = set(rebuilt_sites + reused_sites)
+        site_zips = [(unique_id, os.path.join(site_output_dir(unique_id, take5_sites), f"UP{unique_id}.ZIP"),
+                      [arcname for _, arcname in site_files])
+                     for unique_id, site_files in site_plans if unique_id in built_sites]
+        if status_callback:
+            status_callback(f"Verifying {len(site_zips)} site ZIPs...")
+        with run_report.stage('verify') as record:
+            bad_sites = verify_site_zips(site_zips, workers)
+            record['sites'] = len(site_zips)
+            record['failed_sites'] = sorted(bad_sites)
+        rebuilt_sites = [unique_id for unique_id in rebuilt_sites if unique_id not in bad_sites]
+        reused_sites = [unique_id for unique_id in reused_sites if unique_id not in bad_sites]
+        failed_sites = sorted(set(failed_sites).union(bad_sites))
+    summary = f"{len(rebuilt_sites)} sites rebuilt, {len(reused_sites)} reused"
+    if verify:
+        summary += f", {len(rebuilt_sites) + len(reused_sites)} verified"
+    if failed_sites:
+        summary += f", {len(failed_sites)} of {total_unique_ids} failed, see MASTER.log"
+    if status_callback:
+        status_callback(summary)
+    logger.info("Process completed successfully.")
+    if site_filter:
+        logger.info(f"Partial build of {total_unique_ids} sites, MASTER.CSV, UNUSED.CSV and COVERAGE.CSV left unchanged.")
+    else:
+        with run_report.stage('reports'):
+            replace_unused_csv(UNUSED_CSV_FILENAME + '.tmp', unused_count)
+            write_coverage_csv(coverage_rows)
+    return rebuilt_sites, reused_sites, failed_sites
+
+
+def move_file(source_file, destination_file):
+    # Rename when both paths are on the same filesystem. Otherwise copy in chunks to a temp file next to
+    # the destination, check the copy against the source's SHA-1, rename it into place and only then
+    # remove the source, so the destination never holds a partial file and the source is never lost.
+    try:
+        os.replace(source_file, destination_file)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    temp_path = destination_file + '.tmp'
+    source_hash = hashlib.sha1()
+    copy_hash = hashlib.sha1()
+    try:
+        with open(source_file, 'rb') as source, open(temp_path, 'wb') as destination:
+            for chunk in iter(lambda: source.read(MOVE_CHUNK_SIZE), b''):
+                source_hash.update(chunk)
+                destination.write(chunk)
+            destination.flush()
+            os.fsync(destination.fileno())
+        with open(temp_path, 'rb') as destination:
+            for chunk in iter(lambda: destination.read(MOVE_CHUNK_SIZE), b''):
+                copy_hash.update(chunk)
+        if copy_hash.digest() != source_hash.digest():
+            raise OSError(f"Copy of {source_file} at {destination_file} does not match the source")
+        shutil.copystat(source_file, temp_path)
+        os.replace(temp_path, destination_file)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    os.remove(source_file)
+
+
+def move_folder_contents(source_folder, destination_folder):
+    # Ensure destination folder exists
+    os.makedirs(destination_folder, exist_ok=True)
+
+    # Move entire contents of source folder to destination, merging into folders that already exist there
+    for item in os.listdir(source_folder):
+        source_item = os.path.join(source_folder, item)
+        destination_item = os.path.join(destination_folder, item)
+        if os.path.isdir(source_item):
+            move_folder_contents(source_item, destination_item)
+            os.rmdir(source_item)
+        else:
+            move_file(source_item, destination_item)
+
+    logger.info(f"Contents of {source_folder} moved to {destination_folder} successfully.")
+
+
+def parse_site_filter(site_filter):
+    # Unique_IDs from a comma or space separated list of site numbers and ranges ("0105, 0200-0210"),
+    # or from a CSV in the Take 5 format when site_filter is the path of an existing file
+    if os.path.isfile(site_filter):
+        return set(site_number.zfill(4) for site_number in read_take5_sites(site_filter))
+    sites = set()
+    for item in re.split(r'[,;\s]+', site_filter.strip()):
+        if not item:
+            continue
+        first, _, last = item.partition('-')
+        if not first.isdigit() or (last and not last.isdigit()) or (last and int(first) > int(last)):
+            raise ValueError(f"Invalid site number or range: {item}")
+        sites.update(str(site_number).zfill(4) for site_number in range(int(first), int(last or first) + 1))
+    return sites
+
+
+def list_dat_files(site_filter=None):
+    # Sorted (Unique_ID, path) pairs for every PART####.DAT file, or only those in site_filter,
+    # or [] if the inputs are missing
+    partfiles_dir = partsbox_dir()
+    masterfiles_dir = pronto_aces_dir()
+
+    # Check if directories exist and have files
+    if not os.path.exists(partfiles_dir) or not os.listdir(partfiles_dir):
+        logger.error("PARTSBOX directory is empty or doesn't exist. Please input the necessary data.")
+        return []
+
+    if not os.path.exists(masterfiles_dir) or not os.listdir(masterfiles_dir):
+        logger.error("PRONTO_ACES directory is empty or doesn't exist. Please input the necessary data.")
+        return []
+
+    dat_files = []
+    for filename in sorted(os.listdir(partfiles_dir)):
+        if filename.endswith('.DAT') and re.match(r'PART\d{4}\.DAT', filename):
+            if site_filter is None or filename[4:8] in site_filter:
+                dat_files.append((filename[4:8].zfill(4), os.path.join(partfiles_dir, filename)))
+    return dat_files
+
+
+class StringTable:
+    """Interned strings shared by every PartRecords of a run, each stored once and referred to by index."""
+    __slots__ = ('strings', 'codes')
+
+    def __init__(self):
+        self.strings = []
+        self.codes = {}
+
+    def code(self, value):
+        if self.codes is None:
+            self.codes = {value: code for code, value in enumerate(self.strings)}
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.strings)
+            self.codes[value] = code
+            self.strings.append(value)
+        return code
+
+    def __getstate__(self):
+        # Only the strings are sent between processes, the lookup dict is rebuilt from them when needed
+        return self.strings
+
+    def __setstate__(self, strings):
+        self.strings = strings
+        self.codes = None
+
+
+class PartRecords:
+    """Parsed DAT entries stored column-wise as integer codes into a StringTable.
+
+    Iterating yields the usual (A_<part>_<brand>, description, brand name, Unique_ID) tuples, and
+    split_codes() yields the matching (part code, brand code) pairs without re-splitting the key.
+    """
+    __slots__ = ('table', 'keys', 'part_codes', 'brand_codes', 'descriptions', 'brand_names', 'unique_ids')
+
+    def __init__(self, table=None):
+        self.table = table if table is not None else StringTable()
+        self.keys = array('I')
+        self.part_codes = array('I')
+        self.brand_codes = array('I')
+        self.descriptions = array('I')
+        self.brand_names = array('I')
+        self.unique_ids = array('I')
+
+    def append(self, part_code, brand_code, description, brand_name, unique_id):
+        code = self.table.code
+        self.keys.append(code(f"A_{part_code}_{brand_code}"))
+        self.part_codes.append(code(part_code))
+        self.brand_codes.append(code(brand_code))
+        self.descriptions.append(code(description))
+        self.brand_names.append(code(brand_name))
+        self.unique_ids.append(code(unique_id))
+
+    def extend(self, records):
+        # Append another PartRecords. Records on another StringTable, such as ones parsed in a worker
+        # process, have their strings interned here first and their codes mapped over.
+        if records.table is self.table:
+            for column in self.__slots__[1:]:
+                getattr(self, column).extend(getattr(records, column))
+            return
+        remap = [self.table.code(value) for value in records.table.strings]
+        for column in self.__slots__[1:]:
+            getattr(self, column).extend(map(remap.__getitem__, getattr(records, column)))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        strings = self.table.strings
+        for key, description, brand_name, unique_id in zip(self.keys, self.descriptions, self.brand_names, self.unique_ids):
+            yield (strings[key], strings[description], strings[brand_name], strings[unique_id])
+
+    def split_codes(self):
+        strings = self.table.strings
+        for part_code, brand_code in zip(self.part_codes, self.brand_codes):
+            yield strings[part_code], strings[brand_code]
+
+
+def _decode_dat_lines(file, line_number, malformed_lines):
+    # Decode a DAT file line by line, so one undecodable line is skipped instead of ending the parse.
+    # line_number[0] tracks the last line read, for reporting the lines the csv reader rejects.
+    for line_number[0], line in enumerate(file, start=1):
+        try:
+            yield line.decode(DAT_ENCODING)
+        except UnicodeDecodeError:
+            if line_number[0] == 1:
+                # The header is skipped anyway, it only has to stay the first line
+                yield line.decode(DAT_ENCODING, 'replace')
+            elif malformed_lines is not None:
+                malformed_lines.append(line_number[0])
+
+
+def iter_dat_rows(dat_file, malformed_lines=None):
+    # Yield one (part code, brand code, description, brand name) row per line of a DAT file. Lines are
+    # tokenized with the csv module, so quoted descriptions may contain commas. Lines that do not decode,
+    # have fewer than six fields or have broken quoting are skipped, and their line numbers added to
+    # malformed_lines when given.
+    logger.info(f"Processing file: {os.path.basename(dat_file)}")
+    line_number = [0]
+    with open(dat_file, 'rb') as file:
+        reader = csv.reader(_decode_dat_lines(file, line_number, malformed_lines))
+        # Header line
+        if next(reader, None) is None:
+            return
+        while True:
+            try:
+                fields = next(reader)
+            except StopIteration:
+                break
+            except csv.Error:
+                if malformed_lines is not None:
+                    malformed_lines.append(line_number[0])
+                continue
+            if not fields:
+                continue
+            if len(fields) < 6:
+                if malformed_lines is not None:
+                    malformed_lines.append(line_number[0])
+                continue
+            yield fields[2].replace("A_", ""), fields[4], fields[3], fields[5]
+
+
+def parse_dat_file(unique_id, dat_file, table=None):
+    # Parse one DAT file into PartRecords and return (records, malformed line count). In the parse pool
+    # table is None, so each file gets its own StringTable and only its distinct strings are sent back.
+    records = PartRecords(table)
+    malformed_lines = []
+    for part_code, brand_code, description, brand_name in iter_dat_rows(dat_file, malformed_lines):
+        records.append(part_code, brand_code, description, brand_name, unique_id)
+    if malformed_lines:
+        logger.warning(f"Skipped {len(malformed_lines)} malformed lines in {os.path.basename(dat_file)}, "
+                       f"first at line {malformed_lines[0]}.")
+    return records, len(malformed_lines)
+
+
+def iter_parsed_dat_files(dat_files, workers=1, table=None):
+    # Yield (records, malformed line count) for each (Unique_ID, path) in dat_files, in order. With more than
+    # one worker the files are parsed on a process pool, one file per task, at most DAT_PARSE_AHEAD files
+    # per worker ahead of the caller so memory stays bounded.
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(dat_files) <= 1:
+        for unique_id, dat_file in dat_files:
+            yield parse_dat_file(unique_id, dat_file, table)
+        return
+    with worker_pool(min(workers, len(dat_files))) as executor:
+        pending = deque()
+        dat_files = iter(dat_files)
+        try:
+            while True:
+                while len(pending) < workers * DAT_PARSE_AHEAD:
+                    dat = next(dat_files, None)
+                    if dat is None:
+                        break
+                    pending.append(executor.submit(parse_dat_file, *dat))
+                if not pending:
+                    break
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def iter_site_entries(dat_files, table=None, workers=1, malformed=None):
+    # Yield (Unique_ID, PartRecords) for one site at a time, in site order. Files parsed in this process
+    # share one StringTable; with workers > 1 (None uses one per CPU core) the files are parsed on a process
+    # pool and each site keeps the StringTable it was parsed with, so nothing is re-interned here.
+    # The malformed line count of each DAT file that had any is stored in the malformed dict under its file name.
+    # Sites whose DAT files have no rows are skipped, they get no update ZIP.
+    table = table if table is not None else StringTable()
+    parsed_dat_files = iter_parsed_dat_files(dat_files, workers, table)
+    try:
+        for unique_id, site_dat_files in groupby(zip(dat_files, parsed_dat_files), key=lambda parsed: parsed[0][0]):
+            site_entries = None
+            for (_, dat_file), (records, malformed_count) in site_dat_files:
+                if site_entries is None:
+                    site_entries = records
+                else:
+                    site_entries.extend(records)
+                if malformed is not None and malformed_count:
+                    malformed[os.path.basename(dat_file)] = malformed_count
+            if not len(site_entries):
+                logger.warning(f"Site {unique_id} has no part rows in its DAT files, no update ZIP is built for it.")
+                continue
+            yield unique_id, site_entries
+    finally:
+        parsed_dat_files.close()
+
+
+def parse_dat_files():
+    logger.info("Parsing .DAT files...")
+    data = PartRecords()
+    for _, site_entries in iter_site_entries(list_dat_files(), data.table):
+        data.extend(site_entries)
+    return data
+
+
+def _scan_catalog_folder(folder_path):
+    # List the files directly inside one A_ folder as [name, size, mtime_ns]
+    files = []
+    with os.scandir(folder_path) as entries:
+        for item in entries:
+            if item.is_file():
+                stat = item.stat()
+                files.append([item.name, stat.st_size, stat.st_mtime_ns])
+    files.sort()
+    return files
+
+
+def load_catalog_index(masterfiles_dir=None, index_filename=CATALOG_INDEX_FILENAME, part_codes=None):
+    # With part_codes, only the A_ folders of those parts are indexed and the saved index is left as it is
+    logger.info("Loading PRONTO_ACES catalog index...")
+    masterfiles_dir = masterfiles_dir or pronto_aces_dir()
+
+    # Reuse the saved index for every folder whose mtime has not changed
+    cached_folders = {}
+    if os.path.exists(index_filename):
+        try:
+            with open(index_filename, 'r') as index_file:
+                saved_index = json.load(index_file)
+            if saved_index.get('root') == masterfiles_dir:
+                cached_folders = saved_index.get('folders', {})
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable {index_filename}: {str(e)}")
+
+    folders = {}
+    rescanned = 0
+    if part_codes is not None:
+        for part_code in part_codes:
+            folder_key = os.path.normcase(f'A_{part_code}')
+            # Same precedence as the full scan: A_<part> first, then a folder without the prefix
+            for folder_name in (f'A_{part_code}', part_code):
+                folder_path = os.path.join(masterfiles_dir, folder_name)
+                if not os.path.isdir(folder_path):
+                    continue
+                folder_mtime = os.stat(folder_path).st_mtime_ns
+                cached = cached_folders.get(folder_key)
+                if cached and cached['name'] == folder_name and cached['mtime'] == folder_mtime:
+                    folders[folder_key] = cached
+                else:
+                    folders[folder_key] = {'name': folder_name, 'mtime': folder_mtime, 'files': _scan_catalog_folder(folder_path)}
+                    rescanned += 1
+                break
+        logger.info(f"Catalog index ready for {len(part_codes)} part codes: {len(folders)} folders, {rescanned} rescanned.")
+        return {'root': masterfiles_dir, 'folders': folders}
+
+    with os.scandir(masterfiles_dir) as entries:
+        for item in entries:
+            if not item.is_dir():
+                continue
+            # Folders without the A_ prefix are indexed as A_<name>, as if ingest_folder had renamed them;
+            # a real A_ folder of the same name takes precedence
+            if item.name.startswith('A_'):
+                folder_key = os.path.normcase(item.name)
+            else:
+                folder_key = os.path.normcase('A_' + item.name)
+                if folder_key in folders:
+                    continue
+            folder_mtime = item.stat().st_mtime_ns
+            cached = cached_folders.get(folder_key)
+            if cached and cached['name'] == item.name and cached['mtime'] == folder_mtime:
+                folders[folder_key] = cached
+            else:
+                folders[folder_key] = {'name': item.name, 'mtime': folder_mtime, 'files': _scan_catalog_folder(item.path)}
+                rescanned += 1
+
+    catalog_index = {'root': masterfiles_dir, 'folders': folders}
+    if rescanned or len(folders) != len(cached_folders):
+        with open(index_filename, 'w') as index_file:
+            json.dump(catalog_index, index_file)
+    logger.info(f"Catalog index ready: {len(folders)} folders, {rescanned} rescanned.")
+    return catalog_index
+
+
+def catalog_folder_files(catalog_index, part_code):
+    # Files of PRONTO_ACES/A_<part_code>, or None if the folder does not exist
+    folder = catalog_index['folders'].get(os.path.normcase(f'A_{part_code}'))
+    return folder['files'] if folder else None
+
+
+def catalog_members_for(catalog_index, part_code, brand_code):
+    # (full path, POS/PARTS/<name>) pairs for the catalog files whose names start with A_<part>_<brand>.
+    # Results are shared between sites, so every site referencing a file holds the same strings.
+    part_brand_code = f"A_{part_code}_{brand_code}"
+    match_cache = catalog_index.setdefault('match_cache', {})
+    members = match_cache.get(part_brand_code)
+    if members is None:
+        member_sizes = catalog_index.setdefault('member_sizes', {})
+        members = []
+        folder = catalog_index['folders'].get(os.path.normcase(f'A_{part_code}'))
+        if folder:
+            source_folder = os.path.join(catalog_index['root'], folder['name'])
+            for name, size, _ in folder['files']:
+                if name.startswith(part_brand_code):
+                    source_file = os.path.join(source_folder, name)
+                    member_sizes[source_file] = size
+                    members.append((source_file, f"POS/PARTS/{name}"))
+        members = tuple(members)
+        match_cache[part_brand_code] = members
+    return members
+
+
+def create_update_folders(unique_id, site_entries, catalog_index):
+    logger.info(f"Creating update folders for Unique_ID: {unique_id}...")
+    update_folder = update_dir(unique_id, 'POS', 'PARTS')
+    os.makedirs(update_folder, exist_ok=True)
+
+    # Each file is copied once, and the copies run on a thread pool so reads from a share overlap
+    copies = {}
+    for part_code, brand_code in site_entries.split_codes():
+        for source_file, arcname in catalog_members_for(catalog_index, part_code, brand_code):
+            copies[arcname] = (source_file, update_folder)
+
+    partfiles_dir = partsbox_dir()
+    part_dat_files = [f for f in os.listdir(partfiles_dir) if f.endswith('.DAT') and f.startswith('PART' + unique_id)]
+    for dat_file in part_dat_files:
+        copies[f"POS/{dat_file}"] = (os.path.join(partfiles_dir, dat_file), os.path.join(update_folder, '..'))
+    with ThreadPoolExecutor(max_workers=PREFETCH_THREADS) as executor:
+        for _ in executor.map(lambda copy_args: shutil.copy(*copy_args), copies.values()):
+            pass
+    files_copied = len(copies)
+    bytes_copied = sum(os.path.getsize(source_file) for source_file, _ in copies.values())
+    logger.info("Update folders created successfully.")
+    return files_copied, bytes_copied
+
+
+def zip_update_folder(unique_id, output_directory=None):
+    logger.info(f"Zipping update folder for Unique_ID: {unique_id}...")
+    update_directory = update_dir(unique_id)
+    output_directory = output_directory or update_dir('PROCESSED')
+    os.makedirs(output_directory, exist_ok=True)
+    zip_filename = f"UP{unique_id}.ZIP"
+    # Zip next to the final path and rename, so an interrupted run never leaves a partial ZIP behind
+    temp_path = os.path.join(output_directory, zip_filename + '.tmp')
+    pos_folder = os.path.join(update_directory, 'POS')
+    source_files = [os.path.join(root_path, file) for root_path, _, files in os.walk(pos_folder) for file in files]
+    with zipfile.ZipFile(temp_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        if compressed_members_supported():
+            # Files are read and deflated ahead on the prefetch threads while the members before them are written
+            for (stat, member), source_file in zip(MemberPrefetcher(source_files, load_deflated_member), source_files):
+                write_compressed_member(zipf, os.path.relpath(source_file, update_directory), stat, member)
+        else:
+            for source_file in source_files:
+                zipf.write(source_file, os.path.relpath(source_file, update_directory), compress_type=zipfile.ZIP_DEFLATED)
+    os.replace(temp_path, os.path.join(output_directory, zip_filename))
+    shutil.rmtree(update_directory)
+    logger.info(f"Zipped and moved {update_directory} to {output_directory}.")
+    return os.path.getsize(os.path.join(output_directory, zip_filename))
+
+
+def index_part_dat_files(partfiles_dir=None):
+    # Map each Unique_ID to the PART<id>*.DAT files that belong in its update
+    partfiles_dir = partfiles_dir or partsbox_dir()
+    dat_index = {}
+    for filename in sorted(os.listdir(partfiles_dir)):
+        if filename.endswith('.DAT') and filename.startswith('PART'):
+            dat_index.setdefault(filename[4:8], []).append(os.path.join(partfiles_dir, filename))
+    return dat_index
+
+
+def plan_site_files(unique_id, site_entries, catalog_index, dat_index):
+    # List (source path, archive name) pairs using the same POS/... layout as the staged UPDATE/<id> folder.
+    # Catalog members follow the site's DAT files sorted by archive name, so sites stocking the same catalog
+    # files in a different row order get the same catalog fingerprint and share their members.
+    site_files = [(dat_file, f"POS/{os.path.basename(dat_file)}") for dat_file in dat_index.get(unique_id, [])]
+    catalog_files = {}
+    for part_code, brand_code in site_entries.split_codes():
+        for source_file, arcname in catalog_members_for(catalog_index, part_code, brand_code):
+            catalog_files.setdefault(arcname, source_file)
+    site_files.extend((catalog_files[arcname], arcname) for arcname in sorted(catalog_files))
+    return site_files
+
+
+class CompressedMemberCache:
+    """Raw deflate streams of catalog files, keyed by path, size and mtime.
+
+    Entries live in an LRU capped at max_memory bytes and are always written through to cache_dir,
+    so other worker processes in the same build can reuse them instead of compressing again.
+    """
+    HEADER = struct.Struct('<LQ')  # CRC-32, uncompressed size
+
+    def __init__(self, cache_dir, max_memory=COMPRESSED_CACHE_MEMORY):
+        self.cache_dir = cache_dir
+        self.max_memory = max_memory
+        self.memory_used = 0
+        self.members = OrderedDict()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def load(self, source_file):
+        # Return (stat, (crc, file_size, compressed bytes or None, spill path)) for source_file.
+        # Safe to call from the prefetch threads, it only reads the in-memory LRU.
+        stat = os.stat(source_file)
+        key = f"{source_file}|{stat.st_size}|{stat.st_mtime_ns}"
+        member = self.members.get(key)
+        if member:
+            return stat, member
+
+        spill_path = os.path.join(self.cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest())
+        try:
+            with open(spill_path, 'rb') as spill_file:
+                crc, file_size = self.HEADER.unpack(spill_file.read(self.HEADER.size))
+                compressed = spill_file.read() if stat.st_size <= self.max_memory else None
+        except FileNotFoundError:
+            crc, file_size, compressed = deflate_file(source_file)
+            temp_path = f"{spill_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'wb') as spill_file:
+                spill_file.write(self.HEADER.pack(crc, file_size))
+                spill_file.write(compressed)
+            os.replace(temp_path, spill_path)
+        return stat, (crc, file_size, compressed, spill_path)
+
+    def prefetch(self, source_files):
+        # Yield (stat, member) for each source file in order, loading them ahead on the prefetch threads
+        for (stat, member), source_file in zip(MemberPrefetcher(source_files, self.load), source_files):
+            self.remember(source_file, stat, member)
+            yield stat, member
+
+    def remember(self, source_file, stat, member):
+        key = f"{source_file}|{stat.st_size}|{stat.st_mtime_ns}"
+        if key in self.members:
+            self.members.move_to_end(key)
+        elif member[2] is not None:
+            self._remember(key, member)
+
+    def _remember(self, key, member):
+        size = len(member[2])
+        if size > self.max_memory:
+            return
+        self.members[key] = member
+        self.memory_used += size
+        while self.memory_used > self.max_memory:
+            _, evicted = self.members.popitem(last=False)
+            self.memory_used -= len(evicted[2])
+
+
+def deflate_file(source_file):
+    # (crc, file_size, raw deflate stream) for source_file, with the same compressor settings as
+    # zipfile's ZIP_DEFLATED so the archive bytes do not change. zlib releases the GIL while compressing.
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    crc = 0
+    file_size = 0
+    chunks = []
+    with open(source_file, 'rb') as source:
+        for chunk in iter(lambda: source.read(1024 * 1024), b''):
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            chunks.append(compressor.compress(chunk))
+    chunks.append(compressor.flush())
+    return crc, file_size, b''.join(chunks)
+
+
+def load_deflated_member(source_file):
+    # Uncached counterpart of CompressedMemberCache.load, for files that are zipped only once
+    stat = os.stat(source_file)
+    return stat, deflate_file(source_file) + (None,)
+
+
+class MemberPrefetcher:
+    """Iterates load(source_file) over source_files in order, running the loads ahead on a thread pool.
+
+    load returns (stat, (crc, file_size, compressed bytes or None, spill path)). New loads start while
+    fewer than window are outstanding and the finished ones not yet taken hold less than max_memory
+    compressed bytes, so a slow share is read while earlier members are written.
+    """
+
+    def __init__(self, source_files, load, window=None, max_memory=None, threads=None):
+        self.source_files = source_files
+        self.load = load
+        self.window = window or PREFETCH_WINDOW
+        self.max_memory = max_memory or PREFETCH_MEMORY
+        self.threads = threads or PREFETCH_THREADS
+
+    def _buffered(self, pending):
+        return sum(len(future.result()[1][2] or b'') for future in pending if future.done() and not future.exception())
+
+    def __iter__(self):
+        pending = deque()
+        source_files = iter(self.source_files)
+        executor = ThreadPoolExecutor(max_workers=self.threads)
+        try:
+            while True:
+                while len(pending) < self.window and (not pending or self._buffered(pending) < self.max_memory):
+                    source_file = next(source_files, None)
+                    if source_file is None:
+                        break
+                    pending.append(executor.submit(self.load, source_file))
+                if not pending:
+                    break
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+
+# One cache per process and build directory, so pool workers keep their hot members between sites
+_member_caches = {}
+
+
+def get_member_cache(cache_dir):
+    if cache_dir not in _member_caches:
+        _member_caches[cache_dir] = CompressedMemberCache(cache_dir)
+    return _member_caches[cache_dir]
+
+
+def write_compressed_member(zipf, arcname, stat, member):
+    # Add an already deflated file to zipf; member is (crc, file_size, compressed bytes or None, spill path).
+    # Mirrors ZipFile.write on a seekable file, so the result matches a plain zipf.write byte for byte.
+    crc, file_size, compressed, spill_path = member
+    # Same fields ZipInfo.from_file fills in, taken from the stat the member was loaded with
+    zinfo = zipfile.ZipInfo(arcname, time.localtime(stat.st_mtime)[0:6])
+    zinfo.external_attr = (stat.st_mode & 0xFFFF) << 16
+    zinfo.file_size = stat.st_size
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.flag_bits = 0x00
+    zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+    zinfo.file_size = file_size
+    zinfo.CRC = crc
+    if compressed is not None:
+        zinfo.compress_size = len(compressed)
+    else:
+        zinfo.compress_size = os.path.getsize(spill_path) - CompressedMemberCache.HEADER.size
+
+    zipf.fp.seek(zipf.start_dir)
+    zinfo.header_offset = zipf.fp.tell()
+    zipf._writecheck(zinfo)
+    zipf._didModify = True
+    zipf.fp.write(zinfo.FileHeader(zip64))
+    if compressed is not None:
+        zipf.fp.write(compressed)
+    else:
+        with open(spill_path, 'rb') as spill_file:
+            spill_file.seek(CompressedMemberCache.HEADER.size)
+            shutil.copyfileobj(spill_file, zipf.fp, 1024 * 1024)
+    zipf.start_dir = zipf.fp.tell()
+    zipf.filelist.append(zinfo)
+    zipf.NameToInfo[zinfo.filename] = zinfo
+
+
+def compressed_members_supported():
+    # write_compressed_member and SharedMembers.append_to write into ZipFile's internal state. Check once per
+    # process that this Python's zipfile still gives the same bytes as ZipFile.write; when it does not, the
+    # build falls back to ZipFile.write.
+    global _compressed_members_ok
+    if _compressed_members_ok is None:
+        _compressed_members_ok = _check_compressed_members()
+        if not _compressed_members_ok:
+            logger.warning(f"zipfile in Python {platform.python_version()} does not match the pre-deflated member "
+                           f"writer, site ZIPs are written with ZipFile.write instead.")
+    return _compressed_members_ok
+
+
+_compressed_members_ok = None
+
+
+def _check_compressed_members():
+    # Write a DAT and a catalog member with ZipFile.write, then the catalog member from memory, from the
+    # spill file and through SharedMembers, and compare the archives byte for byte
+    try:
+        with tempfile.TemporaryDirectory() as check_dir:
+            dat_file = os.path.join(check_dir, 'PART0001.DAT')
+            catalog_file = os.path.join(check_dir, 'CHECK.DBF')
+            with open(dat_file, 'w') as check_file:
+                check_file.write('"A","B","PART","DESC","BRAND","NAME"\n' * 20)
+            with open(catalog_file, 'wb') as check_file:
+                check_file.write(bytes(range(256)) * 64)
+            site_files = [(dat_file, 'POS/PART0001.DAT'), (catalog_file, 'POS/PARTS/CHECK.DBF')]
+
+            def archive(add_catalog_member):
+                data = io.BytesIO()
+                with zipfile.ZipFile(data, 'w', zipfile.ZIP_DEFLATED) as zipf:
+                    zipf.write(dat_file, site_files[0][1], compress_type=zipfile.ZIP_DEFLATED)
+                    add_catalog_member(zipf)
+                return data.getvalue()
+
+            expected = archive(lambda zipf: zipf.write(catalog_file, site_files[1][1], compress_type=zipfile.ZIP_DEFLATED))
+            # max_memory=0: the first load returns the deflated bytes, the second reads them from the spill file
+            member_cache = CompressedMemberCache(os.path.join(check_dir, 'cache'), max_memory=0)
+            shared_members = SharedMembers(site_files, member_cache)
+            try:
+                writers = [
+                    lambda zipf: write_compressed_member(zipf, site_files[1][1], *member_cache.load(catalog_file)),
+                    lambda zipf: write_compressed_member(zipf, site_files[1][1], *member_cache.load(catalog_file)),
+                    shared_members.append_to,
+                ]
+                return all(archive(writer) == expected for writer in writers)
+            finally:
+                shared_members.close()
+    except Exception as e:
+        logger.warning(f"Pre-deflated member check failed: {type(e).__name__}: {str(e)}")
+        return False
+
+
+def catalog_fingerprint(site_files):
+    # Identifies a site's catalog file set (plan_site_files lists it sorted); sites with the same fingerprint
+    # get the same catalog bytes
+    fingerprint = hashlib.sha1()
+    for source_file, arcname in site_files:
+        if arcname.startswith('POS/PARTS/'):
+            fingerprint.update(f"{arcname}|{source_file}\n".encode('utf-8'))
+    return fingerprint.hexdigest()
+
+
+class SharedMembers:
+    """Local headers and data of one site's catalog members, built once and copied into every ZIP with the same fingerprint.
+
+    Local headers carry no offsets, so copying them after another member only needs the central
+    directory entries moved along, and the result matches a ZIP written member by member.
+    """
+
+    def __init__(self, site_files, member_cache=None):
+        self.data = tempfile.SpooledTemporaryFile(max_size=COMPRESSED_CACHE_MEMORY)
+        zipf = zipfile.ZipFile(self.data, 'w', zipfile.ZIP_DEFLATED)
+        catalog_files = [(source_file, arcname) for source_file, arcname in site_files if arcname.startswith('POS/PARTS/')]
+        source_files = [source_file for source_file, _ in catalog_files]
+        members = member_cache.prefetch(source_files) if member_cache else MemberPrefetcher(source_files, load_deflated_member)
+        for (stat, member), (_, arcname) in zip(members, catalog_files):
+            write_compressed_member(zipf, arcname, stat, member)
+        self.infos = zipf.infolist()
+        self.size = zipf.start_dir
+        # Not closed: the central directory is written per site ZIP, with the offsets moved
+        zipf._didModify = False
+
+    def append_to(self, zipf):
+        base = zipf.start_dir
+        zipf.fp.seek(base)
+        self.data.seek(0)
+        remaining = self.size
+        while remaining:
+            chunk = self.data.read(min(remaining, 1024 * 1024))
+            zipf.fp.write(chunk)
+            remaining -= len(chunk)
+        for zinfo in self.infos:
+            member = copy.copy(zinfo)
+            member.header_offset += base
+            zipf.filelist.append(member)
+            zipf.NameToInfo[member.filename] = member
+        zipf.start_dir = base + self.size
+        zipf._didModify = True
+
+    def close(self):
+        self.data.close()
+
+
+def write_site_zip(unique_id, site_files, output_directory, member_cache_dir=None, shared_members=None):
+    # Returns the site's stats for the run report: time, files, bytes read and written, compression ratio.
+    # With shared_members, only the site's own PART####.DAT is written and the catalog members are copied from it.
+    logger.info(f"Writing update ZIP for Unique_ID: {unique_id}...")
+    site_start = time.perf_counter()
+    os.makedirs(output_directory, exist_ok=True)
+    zip_path = os.path.join(output_directory, f"UP{unique_id}.ZIP")
+    member_cache = get_member_cache(member_cache_dir) if member_cache_dir else None
+    # Write next to the final path and rename, so a failed site never leaves a truncated ZIP behind
+    temp_path = zip_path + '.tmp'
+    try:
+        # Catalog members are loaded ahead on the prefetch threads, in the order they are written
+        catalog_sources = [source_file for source_file, arcname in site_files if arcname.startswith('POS/PARTS/')]
+        catalog_members = (iter(member_cache.prefetch(catalog_sources))
+                           if member_cache and not shared_members and compressed_members_supported() else None)
+        with zipfile.ZipFile(temp_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            for source_file, arcname in site_files:
+                # Catalog files are shared between sites, the site's own PART####.DAT is not
+                if shared_members and arcname.startswith('POS/PARTS/'):
+                    continue
+                if catalog_members and arcname.startswith('POS/PARTS/'):
+                    write_compressed_member(zipf, arcname, *next(catalog_members))
+                else:
+                    zipf.write(source_file, arcname, compress_type=zipfile.ZIP_DEFLATED)
+            if shared_members:
+                shared_members.append_to(zipf)
+            bytes_read = sum(zinfo.file_size for zinfo in zipf.infolist())
+        os.replace(temp_path, zip_path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    bytes_written = os.path.getsize(zip_path)
+    logger.info(f"Wrote {zip_path} with {len(site_files)} files.")
+    return {
+        'site': unique_id, 'seconds': round(time.perf_counter() - site_start, 4), 'files': len(site_files),
+        'bytes_read': bytes_read, 'bytes_written': bytes_written,
+        'compression_ratio': round(bytes_written / bytes_read, 4) if bytes_read else None,
+    }
+
+
+def write_site_group(site_group, output_directories, member_cache_dir=None):
+    # Write the ZIPs of sites sharing one catalog fingerprint, building their catalog members once.
+    # output_directories maps each Unique_ID to the folder its ZIP goes to.
+    # Returns (Unique_ID, stats, error) per site, so one failing site does not fail the rest of the group.
+    results = []
+    shared_members = None
+    try:
+        if len(site_group) > 1 and compressed_members_supported():
+            member_cache = get_member_cache(member_cache_dir) if member_cache_dir else None
+            try:
+                shared_members = SharedMembers(site_group[0][1], member_cache)
+            except Exception as e:
+                # Every site in the group needs the same catalog members, so they all fail with this error
+                return [(unique_id, None, e) for unique_id, _ in site_group]
+        for unique_id, site_files in site_group:
+            try:
+                results.append((unique_id, write_site_zip(unique_id, site_files, output_directories[unique_id],
+                                                          member_cache_dir, shared_members), None))
+            except Exception as e:
+                results.append((unique_id, None, e))
+    finally:
+        if shared_members:
+            shared_members.close()
+    return results
+
+
+def group_site_plans(site_plans, workers):
+    # Split the plans into groups of sites with the same catalog fingerprint, chunked so the pool stays busy
+    groups = OrderedDict()
+    for unique_id, site_files in site_plans:
+        groups.setdefault(catalog_fingerprint(site_files), []).append((unique_id, site_files))
+    chunk_size = max(1, min(SHARED_MEMBERS_CHUNK, len(site_plans) // (workers * 4)))
+    site_groups = []
+    for group in groups.values():
+        site_groups.extend(group[start:start + chunk_size] for start in range(0, len(group), chunk_size))
+    if site_plans:
+        summary = (f"{len(site_plans)} sites have {len(groups)} distinct catalog file sets, "
+                   f"dedup ratio {len(site_plans) / len(groups):.2f}")
+        # write_site_group only builds SharedMembers on the pre-deflated member path
+        if compressed_members_supported():
+            shared_builds = sum(1 for site_group in site_groups if len(site_group) > 1)
+            summary += f", shared members built {shared_builds} times"
+        else:
+            summary += ", shared members disabled, each site ZIP is written with ZipFile.write"
+        logger.info(summary + ".")
+    return site_groups
+
+
+def build_sites(site_plans, workers=None, progress_callback=None, status_callback=None, run_report=None,
+                cancel_event=None, site_done_callback=None, take5_sites=None, site_bytes=None):
+    # Build every planned site ZIP, spreading sites across a process pool when more than one worker is allowed.
+    # ZIPs of sites in take5_sites are written straight to TAKE5UPDATE, the rest to PROCESSED. Progress is
+    # weighted by site_bytes, the bytes planned per site, which are summed from the files when not given.
+    # A failing site is logged and reported, the remaining sites still build. Returns the failed Unique_IDs.
+    # When cancel_event is set, sites not yet started are dropped, the running ones finish and BuildCancelled is raised.
+    workers = workers or os.cpu_count() or 1
+    total_sites = len(site_plans)
+    failed_sites = []
+    logger.info(f"Building {total_sites} sites with {workers} worker(s)...")
+
+    # Pass folders to the workers explicitly, spawned processes do not see configure_directories()
+    member_cache_dir = update_dir(COMPRESSED_CACHE_DIRNAME)
+    catalog_members = [source_file for _, site_files in site_plans for source_file, arcname in site_files
+                       if arcname.startswith('POS/PARTS/')]
+    logger.info(f"{len(catalog_members)} catalog members share {len(set(catalog_members))} distinct files.")
+    if site_bytes is None:
+        site_bytes = {unique_id: sum(os.path.getsize(source_file) for source_file, _ in site_files)
+                      for unique_id, site_files in site_plans}
+    progress = BuildProgress({unique_id: site_bytes.get(unique_id, 0) for unique_id, _ in site_plans},
+                             progress_callback, status_callback)
+
+    def site_finished(unique_id, site_stats, error):
+        if error is None:
+            message = f"Processing Site Number: {unique_id}"
+            # One structured record per site; in JSON-lines mode the extra fields become keys
+            logger.info(f"Site {unique_id} built: {site_stats['files']} files, {site_stats['bytes_read']} bytes "
+                        f"in {site_stats['seconds'] * 1000:.0f} ms",
+                        extra={'site': unique_id, 'files': site_stats['files'], 'bytes': site_stats['bytes_read'],
+                               'zip_bytes': site_stats['bytes_written'], 'ms': round(site_stats['seconds'] * 1000)})
+            if run_report:
+                run_report.add_site(site_stats)
+            keep_built_zip(unique_id, os.path.join(site_output_dir(unique_id, take5_sites), f"UP{unique_id}.ZIP"))
+            if site_done_callback:
+                site_done_callback(unique_id)
+        else:
+            logger.error(f"Site {unique_id} failed: {error}")
+            failed_sites.append(unique_id)
+            message = f"Site Number {unique_id} failed: {error}"
+            if run_report:
+                run_report.add_site({'site': unique_id, 'error': str(error)})
+        progress.site_done(unique_id, message)
+
+    # Sites with identical catalog members are built together, so their shared part is compressed and laid out once
+    site_groups = group_site_plans(site_plans, workers)
+    output_directories = [{unique_id: site_output_dir(unique_id, take5_sites) for unique_id, _ in site_group}
+                          for site_group in site_groups]
+    try:
+        if workers == 1 or len(site_groups) <= 1:
+            for site_group, group_directories in zip(site_groups, output_directories):
+                if cancel_event and cancel_event.is_set():
+                    break
+                for unique_id, site_stats, error in write_site_group(site_group, group_directories, member_cache_dir):
+                    site_finished(unique_id, site_stats, error)
+        else:
+            with worker_pool(min(workers, len(site_groups))) as executor:
+                futures = {executor.submit(write_site_group, site_group, group_directories, member_cache_dir): site_group
+                           for site_group, group_directories in zip(site_groups, output_directories)}
+                for future in as_completed(futures):
+                    if cancel_event and cancel_event.is_set():
+                        for pending in futures:
+                            pending.cancel()
+                    if future.cancelled():
+                        continue
+                    try:
+                        results = future.result()
+                    except Exception as e:
+                        results = [(unique_id, None, e) for unique_id, _ in futures[future]]
+                    for unique_id, site_stats, error in results:
+                        site_finished(unique_id, site_stats, error)
+    finally:
+        _member_caches.pop(member_cache_dir, None)
+        shutil.rmtree(member_cache_dir, ignore_errors=True)
+
+    if cancel_event and cancel_event.is_set():
+        raise BuildCancelled()
+    if failed_sites:
+        logger.error(f"{len(failed_sites)} of {total_sites} sites failed: {', '.join(sorted(failed_sites))}")
+    return sorted(failed_sites)
+
+
+def verify_site_zip(zip_path, arcnames):
+    # Problems found in one site ZIP, or [] when it is sound. Opening it reads the central directory, and
+    # every member is inflated and checked against the CRC-32 and size recorded when it was compressed,
+    # so the source files are not read again.
+    problems = []
+    try:
+        with zipfile.ZipFile(zip_path) as zipf:
+            names = zipf.namelist()
+            if len(names) != len(set(names)):
+                problems.append("duplicate members")
+            missing = set(arcnames).difference(names)
+            unexpected = set(names).difference(arcnames)
+            if missing:
+                problems.append(f"{len(missing)} planned members missing, e.g. {sorted(missing)[0]}")
+            if unexpected:
+                problems.append(f"{len(unexpected)} members not in the plan, e.g. {sorted(unexpected)[0]}")
+            for zinfo in zipf.infolist():
+                try:
+                    # ZipExtFile checks the CRC-32 once the member is read to the end
+                    with zipf.open(zinfo) as member:
+                        while member.read(VERIFY_CHUNK_SIZE):
+                            pass
+                # A damaged central directory can also name an unknown compression method
+                # (NotImplementedError) or set the encryption bit (RuntimeError)
+                except Exception as e:
+                    problems.append(f"{zinfo.filename}: {type(e).__name__}: {str(e)}")
+    except Exception as e:
+        problems.append(f"{type(e).__name__}: {str(e)}")
+    return problems
+
+
+def verify_site_zips(site_zips, workers=None):
+    # Verify (Unique_ID, ZIP path, planned archive names) triples, spread across a process pool when more
+    # than one worker is allowed. A ZIP that fails is removed so it is never shipped, and the next run builds
+    # it again. Returns the Unique_IDs that failed.
+    workers = workers or os.cpu_count() or 1
+    logger.info(f"Verifying {len(site_zips)} site ZIPs with {workers} worker(s)...")
+    zip_paths = [zip_path for _, zip_path, _ in site_zips]
+    member_lists = [arcnames for _, _, arcnames in site_zips]
+    bad_sites = []
+    if workers == 1 or len(site_zips) <= 1:
+        results = list(map(verify_site_zip, zip_paths, member_lists))
+    else:
+        with worker_pool(min(workers, len(site_zips))) as executor:
+            results = list(executor.map(verify_site_zip, zip_paths, member_lists,
+                                        chunksize=max(1, len(site_zips) // (workers * 4))))
+    for (unique_id, _, _), problems in zip(site_zips, results):
+        if not problems:
+            continue
+        logger.error(f"Site {unique_id} failed verification: {'; '.join(problems)}")
+        bad_sites.append(unique_id)
+        # Also drops the kept copy, so the next run builds the site again
+        discard_stale_zips(unique_id)
+    if bad_sites:
+        logger.error(f"Verification: {len(site_zips) - len(bad_sites)} passed, {len(bad_sites)} failed: {', '.join(bad_sites)}")
+    else:
+        logger.info(f"Verification: {len(site_zips)} passed, 0 failed.")
+    return bad_sites
+
+
+def site_signature(site_files, catalog_stats):
+    # Inputs that decide a site's ZIP contents: a hash of each DAT and the size/mtime of each catalog file
+    signature = {'dat': {}, 'files': []}
+    for source_file, arcname in site_files:
+        if arcname.startswith('POS/PARTS/'):
+            size, mtime = catalog_stats[source_file]
+            signature['files'].append([arcname, source_file, size, mtime])
+        else:
+            with open(source_file, 'rb') as dat_file:
+                signature['dat'][arcname] = hashlib.sha1(dat_file.read()).hexdigest()
+    return signature
+
+
+def load_build_manifest():
+    manifest_path = update_dir(BUILD_MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable {manifest_path}: {str(e)}")
+        return {}
+    if manifest.get('version') != BUILD_MANIFEST_VERSION:
+        return {}
+    return manifest.get('sites', {})
+
+
+def save_build_manifest(sites):
+    manifest_path = update_dir(BUILD_MANIFEST_FILENAME)
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    with open(manifest_path + '.tmp', 'w') as manifest_file:
+        json.dump({'version': BUILD_MANIFEST_VERSION, 'sites': sites}, manifest_file)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def read_take5_sites(take5_file_path):
+    with open(take5_file_path, 'r') as take5_csv:
+        return set(line.strip() for line in take5_csv if line.strip())
+
+
+def site_output_dir(unique_id, take5_sites=None):
+    # Final folder for a site's ZIP: TAKE5UPDATE for Take 5 sites, PROCESSED for everything else
+    return update_dir('TAKE5UPDATE' if take5_sites and unique_id in take5_sites else 'PROCESSED')
+
+
+def discard_stale_zips(unique_id):
+    # Remove last run's UP<id>.ZIP from every output folder and the kept copies before the site is rebuilt,
+    # so a rebuild that fails leaves no outdated archive behind to be shipped as current
+    for output_dirname in OUTPUT_DIRNAMES + (BUILT_ZIPS_DIRNAME,):
+        stale_zip = update_dir(output_dirname, f"UP{unique_id}.ZIP")
+        if os.path.exists(stale_zip):
+            os.remove(stale_zip)
+
+
+def _link_or_copy(source_file, destination_file):
+    try:
+        os.link(source_file, destination_file)
+    except OSError:
+        shutil.copy2(source_file, destination_file)
+
+
+def keep_built_zip(unique_id, zip_path):
+    # Link a finished UP<id>.ZIP into BUILT_ZIPS_DIRNAME, replacing the one kept from an earlier build
+    built_zip = update_dir(BUILT_ZIPS_DIRNAME, f"UP{unique_id}.ZIP")
+    if os.path.exists(built_zip):
+        if os.path.samefile(built_zip, zip_path):
+            return
+        os.remove(built_zip)
+    os.makedirs(os.path.dirname(built_zip), exist_ok=True)
+    _link_or_copy(zip_path, built_zip)
+
+
+def reuse_existing_zip(unique_id, output_directory=None):
+    # Keep last run's UP<id>.ZIP, renaming it into output_directory when the site's Take 5 routing changed,
+    # or restoring it from the kept copy when Move Update took it out of PROCESSED.
+    # Returns False when there is no ZIP to reuse.
+    output_directory = output_directory or update_dir('PROCESSED')
+    zip_path = os.path.join(output_directory, f"UP{unique_id}.ZIP")
+    for output_dirname in OUTPUT_DIRNAMES:
+        existing_zip = update_dir(output_dirname, f"UP{unique_id}.ZIP")
+        if existing_zip != zip_path and os.path.exists(existing_zip):
+            if os.path.exists(zip_path):
+                os.remove(existing_zip)
+            else:
+                os.makedirs(output_directory, exist_ok=True)
+                os.replace(existing_zip, zip_path)
+    built_zip = update_dir(BUILT_ZIPS_DIRNAME, f"UP{unique_id}.ZIP")
+    if not os.path.exists(zip_path) and os.path.exists(built_zip):
+        os.makedirs(output_directory, exist_ok=True)
+        _link_or_copy(built_zip, zip_path)
+    if not os.path.exists(zip_path):
+        return False
+    keep_built_zip(unique_id, zip_path)
+    return True
+
+
+def build_changed_sites(site_plans, workers=None, progress_callback=None, status_callback=None, run_report=None,
+                        cancel_event=None, journal=None, take5_sites=None, site_bytes=None, partial=False):
+    # Rebuild only the sites whose inputs differ from the last build manifest, or that the resumed run
+    # in journal has not built yet, and reuse the other ZIPs. Returns the rebuilt, reused and failed Unique_IDs.
+    # A partial build rebuilds every planned site and keeps the manifest entries of all other sites.
+    previous_sites = load_build_manifest()
+    # Stat each distinct catalog file once, so files rewritten in place are caught even when their folder mtime is not
+    catalog_stats = {}
+    for _, site_files in site_plans:
+        for source_file, arcname in site_files:
+            if arcname.startswith('POS/PARTS/') and source_file not in catalog_stats:
+                stat = os.stat(source_file)
+                catalog_stats[source_file] = (stat.st_size, stat.st_mtime_ns)
+
+    signatures = {}
+    digests = {}
+    changed_plans = []
+    reused_sites = []
+    for unique_id, site_files in site_plans:
+        # Round-trip through JSON so the comparison matches what was saved last time
+        signatures[unique_id] = json.loads(json.dumps(site_signature(site_files, catalog_stats)))
+        digests[unique_id] = hashlib.sha1(json.dumps(signatures[unique_id], sort_keys=True).encode()).hexdigest()
+        unchanged = previous_sites.get(unique_id) == signatures[unique_id]
+        if journal and journal.is_done(unique_id, digests[unique_id]):
+            unchanged = True
+        if partial:
+            unchanged = False
+        if unchanged and reuse_existing_zip(unique_id, site_output_dir(unique_id, take5_sites)):
+            reused_sites.append(unique_id)
+            if run_report:
+                run_report.add_site({'site': unique_id, 'reused': True})
+        else:
+            discard_stale_zips(unique_id)
+            changed_plans.append((unique_id, site_files))
+    logger.info(f"{len(changed_plans)} sites changed since the last build, {len(reused_sites)} unchanged.")
+
+    site_done_callback = (lambda unique_id: journal.site_done(unique_id, digests[unique_id])) if journal else None
+    failed_sites = build_sites(changed_plans, workers, progress_callback, status_callback, run_report,
+                               cancel_event, site_done_callback, take5_sites, site_bytes) if changed_plans else []
+    if progress_callback and not changed_plans:
+        progress_callback(100)
+
+    manifest_sites = {unique_id: signature for unique_id, signature in previous_sites.items()
+                      if unique_id not in signatures} if partial else {}
+    manifest_sites.update((unique_id, signature) for unique_id, signature in signatures.items() if unique_id not in failed_sites)
+    save_build_manifest(manifest_sites)
+    rebuilt_sites = [unique_id for unique_id, _ in changed_plans if unique_id not in failed_sites]
+    logger.info(f"Build finished: {len(rebuilt_sites)} sites rebuilt, {len(reused_sites)} reused, {len(failed_sites)} failed.")
+    return rebuilt_sites, reused_sites, failed_sites
+
+
+def find_unused_entries(entries_with_files, catalog_index, part_has_files=None):
+    # Entries whose A_<part> folder is missing or holds no files. Each distinct part code is looked up
+    # once in the catalog index (pass the same part_has_files dict to share results between calls),
+    # and nothing is created in PRONTO_ACES.
+    part_has_files = {} if part_has_files is None else part_has_files
+    unused_entries = []
+    for entry, (part_code, brand_code) in zip(entries_with_files, entries_with_files.split_codes()):
+        has_files = part_has_files.get(part_code)
+        if has_files is None:
+            folder_files = catalog_folder_files(catalog_index, part_code) or []
+            if logger.isEnabledFor(logging.DEBUG):
+                source_files = [name for name, _, _ in folder_files]
+                logger.debug(f"Checking part code: {part_code}, source folder: A_{part_code}, source files: {source_files}")
+            has_files = part_has_files[part_code] = bool(folder_files)
+        if not has_files:
+            unused_entries.append(entry)
+    return unused_entries
+
+
+def site_coverage(unique_id, site_entries, site_files, catalog_index):
+    # One COVERAGE.CSV row: entries, catalog files matched, entries with no matching catalog file, bytes shipped
+    missing_entries = sum(1 for part_code, brand_code in site_entries.split_codes()
+                          if not catalog_members_for(catalog_index, part_code, brand_code))
+    member_sizes = catalog_index.get('member_sizes', {})
+    matched_files = 0
+    bytes_shipped = 0
+    for source_file, arcname in site_files:
+        if arcname.startswith('POS/PARTS/'):
+            matched_files += 1
+            bytes_shipped += member_sizes[source_file]
+        else:
+            bytes_shipped += os.path.getsize(source_file)
+    return [unique_id, len(site_entries), matched_files, missing_entries, bytes_shipped]
+
+
+def write_coverage_csv(coverage_rows):
+    with open('COVERAGE.CSV', 'w', newline='') as coverage_csv:
+        writer = csv.writer(coverage_csv)
+        writer.writerow(['Unique_ID', 'Entries', 'Matched_Files', 'Missing_Entries', 'Bytes_Shipped'])
+        writer.writerows(coverage_rows)
+    logger.info(f"Coverage for {len(coverage_rows)} sites written to COVERAGE.CSV.")
+
+
+def write_unused_csv(unused_entries):
+    # Write unused entries to UNUSED.CSV
+    if unused_entries:
+        with open(UNUSED_CSV_FILENAME, 'w', newline='') as unused_csv:
+            writer = csv.writer(unused_csv)
+            writer.writerow(['Part_Code_BrandCode', 'Description', 'BrandName', 'Unique_ID'])
+            writer.writerows(unused_entries)
+        logger.info(f"{len(unused_entries)} entries marked as unused in UNUSED.CSV.")
+    else:
+        logger.info("No unused files found in MASTER.CSV.")
+
+
+def replace_unused_csv(unused_csv_path, unused_count):
+    # Move the UNUSED.CSV written during parsing into place; like write_unused_csv, an empty one is not kept
+    if unused_count:
+        os.replace(unused_csv_path, UNUSED_CSV_FILENAME)
+        logger.info(f"{unused_count} entries marked as unused in UNUSED.CSV.")
+    else:
+        os.remove(unused_csv_path)
+        logger.info("No unused files found in MASTER.CSV.")
+
+
+def mark_unused_csv(entries_with_files, catalog_index):
+    logger.info("Marking unused files in UNUSED.CSV...")
+    write_unused_csv(find_unused_entries(entries_with_files, catalog_index))
+
+def move_to_take5_update(take5_sites):
+    # Route ZIPs already in PROCESSED; the build itself writes Take 5 sites straight to TAKE5UPDATE
+    logger.info("Moving files to TAKE5UPDATE directory...")
+    take5_update_dir = update_dir('TAKE5UPDATE')
+    os.makedirs(take5_update_dir, exist_ok=True)
+    for site_number in take5_sites:
+        zip_filename = f"UP{site_number}.ZIP"
+        try:
+            os.replace(update_dir('PROCESSED', zip_filename), os.path.join(take5_update_dir, zip_filename))
+            logger.info(f"Moved UP{site_number}.ZIP to TAKE5UPDATE directory.")
+        except FileNotFoundError:
+            logger.warning(f"UP{site_number}.ZIP not found in PROCESSED directory.")
+
+
+def check_PRONTO_ACES():
+    logger.info("Checking PRONTO_ACES directory for .dbf files...")
+    PRONTO_ACES_dir = pronto_aces_dir()
+    # Stops at the first .DBF, one is enough
+    dbf_files = []
+    for root, dirs, filenames in os.walk(PRONTO_ACES_dir):
+        dbf_files = [os.path.join(root, filename) for filename in filenames if filename.endswith('.DBF')]
+        if dbf_files:
+            logger.debug("Found .dbf file: %s", dbf_files[0])
+            break
+    if not dbf_files:
+        logger.error("No .dbf files found in PRONTO_ACES directory. Please load data into that folder.")
+        raise FileNotFoundError("No .dbf files found in PRONTO_ACES directory. Please load data into that folder.")
+    else:
+        logger.info("At least one .dbf file found in PRONTO_ACES directory.")
+
+
+def _ingest_tree(source_folder, destination_folder, link_files, normalize_prefix, counts):
+    # Mirror source_folder into destination_folder, touching only files whose size or mtime differ
+    os.makedirs(destination_folder, exist_ok=True)
+    expected_names = set()
+    with os.scandir(source_folder) as entries:
+        for item in entries:
+            name = item.name
+            if item.is_dir():
+                if normalize_prefix and not name.startswith('A_'):
+                    name = 'A_' + name
+                expected_names.add(name)
+                _ingest_tree(item.path, os.path.join(destination_folder, name), link_files, False, counts)
+                continue
+
+            expected_names.add(name)
+            target = os.path.join(destination_folder, name)
+            stat = item.stat()
+            try:
+                target_stat = os.stat(target)
+            except FileNotFoundError:
+                target_stat = None
+            # Allow for the 2 second timestamp resolution of FAT and some network shares
+            if target_stat and target_stat.st_size == stat.st_size and abs(target_stat.st_mtime - stat.st_mtime) < 2:
+                counts['unchanged'] += 1
+                continue
+            # Replace through a temp name so a half-copied file is never picked up, and the folder mtime
+            # changes for the catalog index
+            temp_target = target + '.ingest.tmp'
+            if os.path.exists(temp_target):
+                os.remove(temp_target)
+            if link_files:
+                os.link(item.path, temp_target)
+            else:
+                shutil.copy2(item.path, temp_target)
+            os.replace(temp_target, target)
+            counts['copied'] += 1
+
+    for name in os.listdir(destination_folder):
+        if name not in expected_names:
+            stale_item = os.path.join(destination_folder, name)
+            if os.path.isdir(stale_item):
+                shutil.rmtree(stale_item)
+            else:
+                os.remove(stale_item)
+            counts['removed'] += 1
+
+
+def ingest_folder(source_folder, destination_folder, mode=INGEST_MODE, normalize_prefix=False):
+    # Bring a selected PRONTO_ACES or PARTSBOX folder in using one of INGEST_MODES and return the folder
+    # the build should read from. normalize_prefix renames top-level folders to the A_ form the build expects.
+    if mode not in INGEST_MODES:
+        raise ValueError(f"Unknown ingest mode: {mode}")
+    source_folder = os.path.abspath(source_folder)
+    destination_folder = os.path.abspath(destination_folder)
+    if mode == 'in-place' or source_folder == destination_folder:
+        # load_catalog_index applies the A_ prefix to un-prefixed folders without renaming anything here
+        logger.info(f"Using {source_folder} in place.")
+        return source_folder
+
+    link_files = False
+    if mode == 'hardlink':
+        destination_parent = os.path.dirname(destination_folder)
+        os.makedirs(destination_parent, exist_ok=True)
+        if os.stat(source_folder).st_dev == os.stat(destination_parent).st_dev:
+            link_files = True
+        else:
+            logger.info(f"{source_folder} is on another filesystem, copying changed files instead of hardlinking.")
+
+    counts = {'copied': 0, 'unchanged': 0, 'removed': 0}
+    _ingest_tree(source_folder, destination_folder, link_files, normalize_prefix, counts)
+    logger.info(f"Ingested {source_folder} into {destination_folder} ({'hardlink' if link_files else 'sync'}): "
+                f"{counts['copied']} files updated, {counts['unchanged']} unchanged, {counts['removed']} removed.")
+    return destination_folder
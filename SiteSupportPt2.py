@@ -1,70 +1,59 @@
 import os
-import csv
-import shutil
-import zipfile
-import logging
 import sys
+import threading
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QVBoxLayout, QPushButton, QLabel, QWidget,
     QFileDialog, QMessageBox, QCheckBox, QProgressBar, QLineEdit, QDialog,
-    QHBoxLayout  # Add this import
+    QHBoxLayout, QComboBox  # Add this import
 )
 from PyQt5.QtGui import QFont, QIcon, QPixmap
-from PyQt5.QtCore import Qt, QThread, pyqtSignal
+from PyQt5.QtCore import Qt, QThread, QTimer, pyqtSignal
 import qdarkstyle
-import re
-
-# Set up logging
-LOG_FILENAME = "MASTER.log"
-logger = logging.getLogger("MASTER")
+from SiteSupportCore import (
+    logger, BUILD_WORKERS, INGEST_MODE, PROFILE_RUN, BuildCancelled, run_update_build, has_resumable_run,
+    parse_site_filter, configure_directories, update_dir, ingest_folder, move_folder_contents
+)
 
-# Create formatter
-formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
 
-# Create rotating file handler
-handler = logging.FileHandler(LOG_FILENAME)
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+# How often the window picks up the build thread's latest progress, in milliseconds
+PROGRESS_REFRESH_MS = 200
 
 
 class UpdateProcessThread(QThread):
-    update_progress = pyqtSignal(int)
-    update_site_number = pyqtSignal(str)
+    # Errors go to the GUI thread, which shows the dialog
+    build_failed = pyqtSignal(str)
 
     def __init__(self):
         super().__init__()
+        self.workers = BUILD_WORKERS
+        self.profile = PROFILE_RUN
+        self.resume = False
+        self.site_filter = None
+        self.cancel_event = threading.Event()
+        # Latest progress and status of the build; the window reads them on a timer instead of per site
+        self.progress = 0
+        self.status = None
+
+    def set_progress(self, value):
+        self.progress = value
+
+    def set_status(self, message):
+        self.status = message
 
     def run(self):
         global start_button_enabled
         try:
-            check_PRONTO_ACES()
-            data = parse_dat_files()
-            if data:
-                write_to_csv(data, 'MASTER.CSV')
-                entries_with_files = parse_master_csv()
-                unique_ids = list(set(entry[-1] for entry in entries_with_files))
-                total_unique_ids = len(unique_ids)
-                for idx, unique_id in enumerate(unique_ids, start=1):
-                    create_update_folders(unique_id)
-                    zip_update_folder(unique_id)
-                    self.update_progress.emit(int((idx / total_unique_ids) * 100))
-                    self.update_site_number.emit(f"Processing Site Number: {unique_id}")
-                    QApplication.processEvents()
-                logger.info("Process completed successfully.")
-                mark_unused_csv(entries_with_files)                
-                # Move files to TAKE5UPDATE directory if Take5.CSV is included
-                if self.take5_file_path:
-                    with open(self.take5_file_path, 'r') as take5_csv:
-                        take5_sites = [line.strip() for line in take5_csv if line.strip()]
-                    move_to_take5_update(take5_sites)
-
+            result = run_update_build(self.take5_file_path, self.workers, self.set_progress, self.set_status,
+                                      self.profile, self.cancel_event, self.resume, self.site_filter)
+            if result is not None:
                 start_button_enabled = True
             else:
-                logger.error("No .DAT files found or PARTSBOX directory is empty or doesn't exist.")
-                QMessageBox.critical(None, "Error", "No .DAT files found or PARTSBOX directory is empty or doesn't exist.")
+                self.build_failed.emit("No .DAT files found or PARTSBOX directory is empty or doesn't exist.")
+        except BuildCancelled:
+            self.status = "Build cancelled, press Resume Update Build to finish the remaining sites"
         except Exception as e:
             logger.exception(f"An error occurred: {str(e)}")
-            QMessageBox.critical(None, "Error", f"An error occurred: {str(e)}")
+            self.build_failed.emit(f"An error occurred: {str(e)}")
 
 
 class LoginDialog(QDialog):
@@ -122,10 +111,36 @@ class UpdateProcessApp(QMainWindow):
         self.progress_bar.setValue(0)
         self.layout.addWidget(self.progress_bar)
 
+        # Picks up the build thread's progress at a fixed rate while a build runs
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setInterval(PROGRESS_REFRESH_MS)
+        self.refresh_timer.timeout.connect(self.refresh_progress)
+
         self.include_take5_checkbox = QCheckBox("Include CSV of Take 5 Sites")
         self.include_take5_checkbox.setFont(QFont("Arial", 12))
         self.layout.addWidget(self.include_take5_checkbox)
 
+        # How the selected PRONTO_ACES and PARTSBOX folders are brought in
+        self.ingest_mode_combo = QComboBox()
+        self.ingest_mode_combo.setFont(QFont("Arial", 12))
+        self.ingest_mode_combo.addItem("Copy only new or changed files", 'sync')
+        self.ingest_mode_combo.addItem("Hardlink files (same drive only)", 'hardlink')
+        self.ingest_mode_combo.addItem("Build from the selected folders in place", 'in-place')
+        self.ingest_mode_combo.setCurrentIndex(self.ingest_mode_combo.findData(INGEST_MODE))
+        self.layout.addWidget(self.ingest_mode_combo)
+
+        # Saves MASTER.prof next to MASTER.log for finding slow stages
+        self.profile_checkbox = QCheckBox("Profile this run")
+        self.profile_checkbox.setFont(QFont("Arial", 12))
+        self.profile_checkbox.setChecked(PROFILE_RUN)
+        self.layout.addWidget(self.profile_checkbox)
+
+        # Rebuilds only the listed sites; left empty the whole broadcast is built
+        self.site_filter_input = QLineEdit()
+        self.site_filter_input.setFont(QFont("Arial", 12))
+        self.site_filter_input.setPlaceholderText("All sites, or e.g. 0105, 0200-0210, or a CSV path")
+        self.layout.addWidget(self.site_filter_input)
+
         # Calculate the width of the buttons
         max_button_width = max(
             len("Start Update Build"),
@@ -154,6 +169,42 @@ class UpdateProcessApp(QMainWindow):
             """
         )
 
+        # Resume button
+        self.resume_button = QPushButton("Resume Update Build")
+        self.resume_button.setFont(QFont("Arial", 12))
+        self.resume_button.setFixedWidth(max_button_width)  # Set fixed width
+        self.resume_button.clicked.connect(self.resume_update_process)
+        self.add_help_button(
+            self.resume_button,
+            "Click for help",
+            """
+            <html>
+            <body>
+            <p style='font-size:12pt; color:white'><b>Resume Update Build Button</b></p>
+            <p style='font-size:10pt'>This button continues an update build that was cancelled, or stopped because the program was closed or the computer restarted. Sites that were already built are skipped, everything else is built as with the Start Update Build button. Select the same PRONTO_ACES and PARTSBOX folders first.</p>
+            </body>
+            </html>
+            """
+        )
+
+        # Cancel button
+        self.cancel_button = QPushButton("Cancel Update Build")
+        self.cancel_button.setFont(QFont("Arial", 12))
+        self.cancel_button.setFixedWidth(max_button_width)  # Set fixed width
+        self.cancel_button.clicked.connect(self.cancel_update_process)
+        self.add_help_button(
+            self.cancel_button,
+            "Click for help",
+            """
+            <html>
+            <body>
+            <p style='font-size:12pt; color:white'><b>Cancel Update Build Button</b></p>
+            <p style='font-size:10pt'>This button stops a running update build once the sites currently being zipped are finished. The finished UP####.ZIP files are kept, and the Resume Update Build button picks up where the build stopped.</p>
+            </body>
+            </html>
+            """
+        )
+
         # Master files button
         self.masterfiles_button = QPushButton("Select PRONTO_ACES Folder")
         self.masterfiles_button.setFont(QFont("Arial", 12))
@@ -217,6 +268,8 @@ class UpdateProcessApp(QMainWindow):
         self.update_thread = None
         self.masterfiles_found = False
         self.partfiles_found = False
+        self.masterfiles_dir = None
+        self.partfiles_dir = None
         self.check_start_button_state()
         self.check_button_color()
 
@@ -232,7 +285,7 @@ class UpdateProcessApp(QMainWindow):
             <html>
             <body>
             <p style='font-size:12pt; color:white'><b>Move Update Button</b></p>
-            <p style='font-size:10pt'>This button is used for selecting the folder to move the update to. This will move the contents of (CURRENT DIRECTORY)\\UPDATE\\PROCESSED to whatever folder is selected by the user, when the button is pressed. This is used to send out the update once it has finished building</p>
+            <p style='font-size:10pt'>This button is used for selecting the folder to move the update to. This will move the contents of (CURRENT DIRECTORY)\\UPDATE\\PROCESSED to whatever folder is selected by the user, when the button is pressed. This is used to send out the update once it has finished building. A copy of every ZIP is kept in (CURRENT DIRECTORY)\\UPDATE\\.BUILT_ZIPS, so the next update build can reuse the sites that did not change instead of building them again.</p>
             </body>
             </html>
             """
@@ -242,7 +295,7 @@ class UpdateProcessApp(QMainWindow):
         # Prompt user to select a folder
         folder_path = QFileDialog.getExistingDirectory(self, "Select Update Destination Folder")
         if folder_path:
-            source_folder = os.path.join(os.getcwd(), 'UPDATE', 'PROCESSED')
+            source_folder = update_dir('PROCESSED')
             # Check if the source folder exists
             if os.path.exists(source_folder):
                 # Move contents of PROCESSED directory to the selected folder
@@ -288,10 +341,12 @@ class UpdateProcessApp(QMainWindow):
             self.start_button.setStyleSheet("QPushButton {background-color: #008CBA; color: white; border-radius: 5px;}"
                                              "QPushButton:hover {background-color: #006080;}")
             self.start_button.setEnabled(True)
+            self.resume_button.setEnabled(has_resumable_run())
         else:
             self.start_button.setStyleSheet("QPushButton {background-color: #FF5733; color: white; border-radius: 5px;}"
                                              "QPushButton:hover {background-color: #FF5733;}")
             self.start_button.setEnabled(False)
+            self.resume_button.setEnabled(False)
 
     def select_take5_file(self):
         file_path, _ = QFileDialog.getOpenFileName(self, "Select CSV of Take 5 Sites", "", "CSV Files (*.csv)")
@@ -300,29 +355,21 @@ class UpdateProcessApp(QMainWindow):
             self.take5_file_path = file_path
 
     def select_masterfiles_folder(self):
-        # Delete PRONTO_ACES folder before selecting files
-        masterfiles_dir = os.path.join(os.getcwd(), 'PRONTO_ACES')
-        if os.path.exists(masterfiles_dir):
-            shutil.rmtree(masterfiles_dir)
-
         folder_path = QFileDialog.getExistingDirectory(self, "Select PRONTO_ACES Folder")
         if folder_path:
-            # Call function to copy contents of selected folder to PRONTO_ACES
-            copy_folder_contents(folder_path, "PRONTO_ACES")
+            # Bring the selected folder in as PRONTO_ACES using the chosen ingest mode
+            self.masterfiles_dir = ingest_folder(folder_path, os.path.join(os.getcwd(), 'PRONTO_ACES'),
+                                                 self.ingest_mode_combo.currentData(), normalize_prefix=True)
             self.masterfiles_found = True
             self.check_start_button_state()
             self.check_button_color()
 
     def select_partfiles_folder(self):
-        # Delete PARTSBOX folder before selecting files
-        partfiles_dir = os.path.join(os.getcwd(), 'PARTSBOX')
-        if os.path.exists(partfiles_dir):
-            shutil.rmtree(partfiles_dir)
-
         folder_path = QFileDialog.getExistingDirectory(self, "Select PARTSBOX Folder")
         if folder_path:
-            # Call function to copy contents of selected folder to PARTSBOX
-            copy_folder_contents(folder_path, "PARTSBOX")
+            # Bring the selected folder in as PARTSBOX using the chosen ingest mode
+            self.partfiles_dir = ingest_folder(folder_path, os.path.join(os.getcwd(), 'PARTSBOX'),
+                                               self.ingest_mode_combo.currentData())
             self.partfiles_found = True
             self.check_start_button_state()
             self.check_button_color()
@@ -334,215 +381,46 @@ class UpdateProcessApp(QMainWindow):
         else:
             start_button_enabled = False
 
-    def start_update_process(self):
+    def start_update_process(self, resume=False):
         if self.update_thread is None or not self.update_thread.isRunning():
+            try:
+                site_filter = parse_site_filter(self.site_filter_input.text()) or None
+            except ValueError as e:
+                QMessageBox.warning(self, "Site Filter", str(e))
+                return
+            configure_directories(self.partfiles_dir, self.masterfiles_dir)
             self.update_thread = UpdateProcessThread()
-            self.update_thread.update_progress.connect(self.update_progress_bar)
-            self.update_thread.update_site_number.connect(self.update_site_number)
+            self.update_thread.resume = resume
+            self.update_thread.site_filter = site_filter
+            self.update_thread.finished.connect(self.build_finished)
+            self.update_thread.build_failed.connect(self.show_build_error)
             self.update_thread.take5_file_path = self.take5_file_path if hasattr(self, 'take5_file_path') else None
+            self.update_thread.profile = self.profile_checkbox.isChecked()
             self.update_thread.start()
+            self.refresh_timer.start()
+
+    def resume_update_process(self):
+        self.start_update_process(resume=True)
+
+    def cancel_update_process(self):
+        if self.update_thread is not None and self.update_thread.isRunning():
+            self.update_thread.cancel_event.set()
+            self.update_thread.status = "Cancelling after the sites in progress..."
+
+    def refresh_progress(self):
+        if self.update_thread is None:
+            return
+        self.progress_bar.setValue(self.update_thread.progress)
+        if self.update_thread.status:
+            self.progress_label.setText(self.update_thread.status)
+
+    def build_finished(self):
+        self.refresh_timer.stop()
+        self.refresh_progress()
+        self.check_button_color()
 
-    def update_progress_bar(self, value):
-        self.progress_bar.setValue(value)
-
-    def update_site_number(self, site_number):
-        self.progress_label.setText(site_number)
-
-def move_folder_contents(source_folder, destination_folder):
-    # Ensure destination folder exists
-    os.makedirs(destination_folder, exist_ok=True)
-
-    # Move entire contents of source folder to destination
-    for item in os.listdir(source_folder):
-        source_item = os.path.join(source_folder, item)
-        destination_item = os.path.join(destination_folder, item)
-        if os.path.isdir(source_item):
-            shutil.move(source_item, destination_item)
-        else:
-            shutil.move(source_item, destination_item)
-
-    logger.info(f"Contents of {source_folder} moved to {destination_folder} successfully.")
-
-
-def parse_dat_files():
-    logger.info("Parsing .DAT files...")
-    data = []
-
-    partfiles_dir = os.path.join(os.getcwd(), 'PARTSBOX')
-    masterfiles_dir = os.path.join(os.getcwd(), 'PRONTO_ACES')
-
-    # Check if directories exist and have files
-    if not os.path.exists(partfiles_dir) or not os.listdir(partfiles_dir):
-        logger.error("PARTSBOX directory is empty or doesn't exist. Please input the necessary data.")
-        return []
-
-    if not os.path.exists(masterfiles_dir) or not os.listdir(masterfiles_dir):
-        logger.error("PRONTO_ACES directory is empty or doesn't exist. Please input the necessary data.")
-        return []
-
-    # Process DAT files
-    for filename in os.listdir(partfiles_dir):
-        if filename.endswith('.DAT') and re.match(r'PART\d{4}\.DAT', filename):
-            logger.info(f"Processing file: {filename}")
-            unique_id = filename[4:8].zfill(4)
-            with open(os.path.join(partfiles_dir, filename), 'r') as file:
-                next(file)
-                for line in file:
-                    parts = line.strip().split(',')
-                    part_code = parts[2].strip('"').replace("A_", "")
-                    brand_code = parts[4].strip('"')
-                    description = parts[3].strip('"')
-                    brand_name = parts[5].strip('"')
-                    data.append((f"A_{part_code}_{brand_code}", description, brand_name, unique_id))
-
-    return data
-
-def start_update_process(self):
-    if self.update_thread is None or not self.update_thread.isRunning():
-        self.update_thread = UpdateProcessThread()
-        self.update_thread.update_progress.connect(self.update_progress_bar)
-        self.update_thread.update_site_number.connect(self.update_site_number)
-        self.update_thread.take5_file_path = self.take5_file_path if hasattr(self, 'take5_file_path') else None
-        self.update_thread.start()
-
-def write_to_csv(data, filename):
-    with open(filename, 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(['Part_Code_BrandCode', 'Description', 'BrandName', 'Unique_ID'])
-        writer.writerows(data)
-
-
-def parse_master_csv():
-    logger.info("Parsing MASTER.CSV...")
-    entries_with_files = []
-    with open('MASTER.CSV', 'r') as csvfile:
-        reader = csv.reader(csvfile)
-        next(reader)
-        for row in reader:
-            entries_with_files.append(row)
-    # Sort entries based on Unique_ID
-    entries_with_files.sort(key=lambda x: x[-1])
-    logger.info(f"Entries found in MASTER.CSV: {len(entries_with_files)}")
-    return entries_with_files
-
-
-def create_update_folders(unique_id):
-    logger.info(r"Creating update folders for Unique_ID: {unique_id}...")
-    update_folder = os.path.join(os.getcwd(), 'UPDATE', unique_id, 'POS', 'PARTS')
-    os.makedirs(update_folder, exist_ok=True)
-
-    with open('MASTER.CSV', 'r') as csvfile:
-        reader = csv.reader(csvfile)
-        next(reader)
-        for row in reader:
-            if row[-1] == unique_id:
-                part_brand_code = row[0]
-                part_code, brand_code = part_brand_code.split('_')[1:]
-                source_folder = os.path.join(os.getcwd(), 'PRONTO_ACES', f'A_{part_code}')
-                if os.path.exists(source_folder):
-                    for filename in os.listdir(source_folder):
-                        if filename.startswith(part_brand_code):
-                            shutil.copy(os.path.join(source_folder, filename), update_folder)
-
-    partfiles_dir = os.path.join(os.getcwd(), 'PARTSBOX')
-    part_dat_files = [f for f in os.listdir(partfiles_dir) if f.endswith('.DAT') and f.startswith('PART' + unique_id)]
-    for dat_file in part_dat_files:
-        shutil.copy(os.path.join(partfiles_dir, dat_file), os.path.join(update_folder, '..'))
-    logger.info("Update folders created successfully.")
-
-
-def zip_update_folder(unique_id):
-    logger.info(f"Zipping update folder for Unique_ID: {unique_id}...")
-    update_directory = os.path.join(os.getcwd(), 'UPDATE', unique_id)
-    processed_directory = os.path.join(os.getcwd(), 'UPDATE', 'PROCESSED')
-    os.makedirs(processed_directory, exist_ok=True)
-    zip_filename = f"UP{unique_id}.ZIP"
-    with zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        pos_folder = os.path.join(update_directory, 'POS')
-        for root_path, _, files in os.walk(pos_folder):
-            for file in files:
-                zipf.write(os.path.join(root_path, file), os.path.relpath(os.path.join(root_path, file), update_directory), compress_type=zipfile.ZIP_DEFLATED)
-    shutil.move(zip_filename, os.path.join(processed_directory, zip_filename))
-    shutil.rmtree(update_directory)
-    logger.info(f"Zipped and moved {update_directory} to {processed_directory}.")
-
-
-def mark_unused_csv(entries_with_files):
-    logger.info("Marking unused files in UNUSED.CSV...")
-    unused_entries = []
-
-    # Check if entries have corresponding files in PRONTO_ACES directory
-    for entry in entries_with_files:
-        part_code_brand_code = entry[0]
-        part_code, brand_code = part_code_brand_code.split('_')[1:]
-        source_folder = os.path.join(os.getcwd(), 'PRONTO_ACES', f'A_{part_code}')
-        # Create directory if it doesn't exist
-        if not os.path.exists(source_folder):
-            os.makedirs(source_folder, exist_ok=True)
-        source_files = [f for f in os.listdir(source_folder) if os.path.isfile(os.path.join(source_folder, f))]
-        logger.debug(f"Checking part code: {part_code}, brand code: {brand_code}, source folder: {source_folder}, source files: {source_files}")
-        if not source_files:
-            unused_entries.append(entry)
-
-    # Write unused entries to UNUSED.CSV
-    if unused_entries:
-        with open('UNUSED.CSV', 'w', newline='') as unused_csv:
-            writer = csv.writer(unused_csv)
-            writer.writerow(['Part_Code_BrandCode', 'Description', 'BrandName', 'Unique_ID'])
-            writer.writerows(unused_entries)
-        logger.info(f"{len(unused_entries)} entries marked as unused in UNUSED.CSV.")
-    else:
-        logger.info("No unused files found in MASTER.CSV.")
-
-def move_to_take5_update(take5_sites):
-    logger.info("Moving files to TAKE5UPDATE directory...")
-    take5_update_dir = os.path.join(os.getcwd(), 'UPDATE', 'TAKE5UPDATE')
-    os.makedirs(take5_update_dir, exist_ok=True)
-    for site_number in take5_sites:
-        zip_filename = f"UP{site_number}.ZIP"
-        if os.path.exists(os.path.join(os.getcwd(), 'UPDATE', 'PROCESSED', zip_filename)):
-            shutil.move(os.path.join(os.getcwd(), 'UPDATE', 'PROCESSED', zip_filename), take5_update_dir)
-            logger.info(f"Moved UP{site_number}.ZIP to TAKE5UPDATE directory.")
-        else:
-            logger.warning(f"UP{site_number}.ZIP not found in PROCESSED directory.")
-
-
-def check_PRONTO_ACES():
-    logger.info("Checking PRONTO_ACES directory for .dbf files...")
-    PRONTO_ACES_dir = os.path.join(os.getcwd(), 'PRONTO_ACES')
-    dbf_files = []
-    for root, dirs, filenames in os.walk(PRONTO_ACES_dir):
-        for filename in filenames:
-            if filename.endswith('.DBF'):
-                logger.debug(f"Found .dbf file: {filename}")
-                dbf_files.append(os.path.join(root, filename))
-    if not dbf_files:
-        logger.error("No .dbf files found in PRONTO_ACES directory. Please load data into that folder.")
-        raise FileNotFoundError("No .dbf files found in PRONTO_ACES directory. Please load data into that folder.")
-    else:
-        logger.info("At least one .dbf file found in PRONTO_ACES directory.")
-
-
-def copy_folder_contents(source_folder, destination_folder):
-    # Ensure destination folder exists
-    os.makedirs(destination_folder, exist_ok=True)
-
-    # Copy entire contents of source folder to destination
-    for item in os.listdir(source_folder):
-        source_item = os.path.join(source_folder, item)
-        destination_item = os.path.join(destination_folder, item)
-        if os.path.isdir(source_item):
-            shutil.copytree(source_item, destination_item)
-        else:
-            shutil.copy(source_item, destination_item)
-
-    # If destination is PRONTO_ACES, ensure subfolders start with 'A_'
-    if destination_folder == "PRONTO_ACES":
-        for item in os.listdir(destination_folder):
-            if os.path.isdir(os.path.join(destination_folder, item)) and not item.startswith("A_"):
-                os.rename(os.path.join(destination_folder, item), os.path.join(destination_folder, "A_" + item))
-
-    logger.info(f"Contents of {source_folder} copied to {destination_folder} successfully.")
+    def show_build_error(self, message):
+        QMessageBox.critical(self, "Error", message)
 
 
 def main():
@@ -556,4 +434,4 @@ def main():
 
 if __name__ == "__main__":
     start_button_enabled = False
-    main()
\ No newline at end of file
+    main()